@@ -1,18 +1,28 @@
 import logging
 import os
+import time
+from collections import deque
 from datetime import datetime
 
 import streamlit as st
 import streamlit_toggle as tog
 
-from jaivus.chat import get_chatbot
-from jaivus.download import download_button
-from jaivus.listen import get_listener
-from jaivus.speak import get_speaker
+from jaivus.chat import Conversation, get_chatbot, get_response_cache, is_stateful
+from jaivus.listen import get_listener, get_wake_word_detector
+from jaivus.pool import ENGINES
+from jaivus.runtime import get_runtime
+from jaivus.speak import AUDIO_CACHE, get_speaker
+from jaivus.trace import TRACER
+from jaivus.transcript import EXPORT_FORMATS, TranscriptLog
 
 logger = logging.getLogger(__name__)
 
 WAKE_WORD = "Jarvis"
+WAKE_WORD_DETECTOR = "sphinx"
+WAKE_WORD_PROMPT = "Say the wake word to start the conversation:"
+WAKE_WORD_DETECTED = "Wake word detected, starting conversation"
+CONVERSATION_START = "Starting conversation"
+CONVERSATION_RESUMED = "Resuming conversation"
 
 # Init streamlit session and stateful parameters
 SESSION = st.session_state
@@ -37,12 +47,18 @@ if "listener" not in SESSION:
     SESSION["listener"] = "web"
 if "config" not in SESSION:
     SESSION["config"] = "config.json"
-if "conversation" not in SESSION:
-    SESSION["conversation"] = []
+if "transcript" not in SESSION:
+    SESSION["transcript"] = TranscriptLog()
+if "chat_context" not in SESSION:
+    SESSION["chat_context"] = Conversation(assistant=WAKE_WORD)
 if "local_mode" not in SESSION:
     SESSION["local_mode"] = False
 if "mute" not in SESSION:
     SESSION["mute"] = True
+if "debug" not in SESSION:
+    SESSION["debug"] = False
+if "barge_in" not in SESSION:
+    SESSION["barge_in"] = False
 
 
 # Helper methods
@@ -50,10 +66,30 @@ def stop_app():
     # Callable for reset button
     SESSION["start_app"] = False
     SESSION["run_app"] = False
-    SESSION["conversation"] = []
+    get_runtime().stop_session(SESSION["transcript"].session_id)
+    SESSION["transcript"].clear()
+    SESSION["transcript"] = TranscriptLog()
+    SESSION["chat_context"] = Conversation(assistant=WAKE_WORD)
     logger.info("stop the app")
 
 
+def show_debug_panel(panel, session_id, turns=5):
+    # span durations in seconds of the last turns and the process metrics
+    with panel.container():
+        st.caption("Last turns (seconds)")
+        st.table(
+            [
+                dict(
+                    {span["name"]: span["duration"] for span in turn["spans"]},
+                    turn=turn["duration"],
+                )
+                for turn in TRACER.recent_turns(session_id)
+            ][-turns:]
+        )
+        with st.expander("Metrics"):
+            st.code(TRACER.export_prometheus())
+
+
 ## Streamlit app header
 st.set_page_config(
     page_title="jAIvus [ʤɑ́ːvɪs]",
@@ -94,6 +130,16 @@ with st.sidebar:
                 value=False,
                 help="Experimental mode using different libraries, only works if app is deployed locally",
             )
+            SESSION["barge_in"] = st.checkbox(
+                "interruptible answers",
+                value=False,
+                help="Keeps listening while Jarvis answers, speaking interrupts the answer",
+            )
+            SESSION["debug"] = st.checkbox(
+                "debug panel",
+                value=False,
+                help="Traces the latency of each turn and shows the last turns",
+            )
 
         # Submit button
         submitted = st.form_submit_button("Submit")
@@ -124,8 +170,17 @@ with st.sidebar:
     if SESSION["start_app"]:
         # Reset button
         st.button("Reset", on_click=stop_app)
-        # Download button container
-        dowload_button = st.empty()
+        # Export the transcript on demand, nothing is encoded per turn
+        export_format = st.selectbox("Export format", list(EXPORT_FORMATS))
+        if st.button("Export conversation"):
+            st.download_button(
+                "Download conversation",
+                data="".join(SESSION["transcript"].export(export_format)),
+                file_name=f"jaivus_conversation_{str(datetime.now())}.{export_format}",
+                mime=EXPORT_FORMATS[export_format],
+            )
+        # Debug panel container
+        debug_panel = st.empty()
     else:
         # Advanced Settings toggle
         tog.st_toggle_switch(label="Advanced Settings", key="advanced_settings")
@@ -139,68 +194,142 @@ try:
             status_indicator.write("Select audio source and press **'Start'**")
         else:
             status_indicator.write("Initializing engines")
-        listen = get_listener(SESSION["listener"], SESSION["recognizer"])
+        # engines of the pool the conversation uses, kept while it runs
+        pooled = []
+        if SESSION["listener"] == "web":
+            # the web listener renders the webrtc component, it is built every run
+            listen = get_listener(SESSION["listener"], SESSION["recognizer"])
+        else:
+            listen = ENGINES.get(
+                "listener",
+                (SESSION["listener"], SESSION["recognizer"]),
+                lambda: get_listener(SESSION["listener"], SESSION["recognizer"]),
+            )
+            pooled.append(("listener", (SESSION["listener"], SESSION["recognizer"])))
 
     if SESSION["start_app"] and listen.is_active:
         # Initialize engines
         logger.info(f"start the app with config {SESSION['config']}")
-        speak = get_speaker(SESSION["speaker"])
-        chat = get_chatbot(SESSION["chatbot"], SESSION["config"])
-
-        # Wake-up Loop
-        if SESSION["wake_word"]:
-            # Wake-up instructions
-            logger.info(f"waiting for wake word: {WAKE_WORD}")
-            text = "Say the wake word to start the conversation:"
-            status_indicator.write(f'{text} **"{WAKE_WORD}"**')
-            speak.speak(text)
-
-            with st.spinner("**Listening**"):
-                while SESSION["run_app"]:
-                    # Record audio until the wake word is spoken
-                    command = listen.listen(number_of_chunks=5000)
-                    if command is not None:
-                        if WAKE_WORD.lower() in command.lower():
-                            break
-
-            # Transition to conversation loop
-            text = "Wake word detected, starting conversation"
+        # Engines are shared across reruns and sessions with the same config
+        speak = ENGINES.get(
+            "speaker",
+            SESSION["speaker"],
+            lambda: get_speaker(SESSION["speaker"]),
+        ).session()
+        speak.warmup([WAKE_WORD_PROMPT, WAKE_WORD_DETECTED, CONVERSATION_START])
+        pooled.append(("speaker", SESSION["speaker"]))
+        session_id = SESSION["transcript"].session_id
+        # bots keeping the conversation upstream are not shared across users
+        chatbot_key = (SESSION["chatbot"], SESSION["config"])
+        if is_stateful(SESSION["chatbot"]):
+            chatbot_key += (session_id,)
+        chat = ENGINES.get(
+            "chatbot",
+            chatbot_key,
+            lambda: get_chatbot(
+                SESSION["chatbot"], SESSION["config"], cache=get_response_cache()
+            ),
+        )
+        pooled.append(("chatbot", chatbot_key))
+        TRACER.collect("engines", ENGINES)
+        TRACER.collect("audio_cache", AUDIO_CACHE)
+        TRACER.collect("chatbot", chat)
+        if getattr(chat, "client", None) is not None:
+            TRACER.collect("openai_client", chat.client)
+        if getattr(speak, "pool", None) is not None:
+            TRACER.collect("synthesis", speak.pool)
+        if SESSION["listener"] == "web":
+            TRACER.collect("receiver", listen.streamer.frames, session=session_id)
+
+        # The conversation runs in the runtime, the page renders its events
+        runtime = get_runtime()
+        TRACER.collect("runtime", runtime)
+        session = runtime.get_session(session_id)
+        if session is None:
+            detector = None
+            if SESSION["wake_word"]:
+                # Spot the wake word locally, falls back to the recognizer
+                logger.info(f"waiting for wake word: {WAKE_WORD}")
+                detector = ENGINES.get(
+                    "wake_word_detector",
+                    (WAKE_WORD_DETECTOR, WAKE_WORD),
+                    lambda: get_wake_word_detector(WAKE_WORD_DETECTOR, WAKE_WORD),
+                )
+            session = runtime.start_session(
+                session_id,
+                listener=listen,
+                chatbot=chat,
+                speaker=speak,
+                conversation=SESSION["chat_context"],
+                transcript=SESSION["transcript"],
+                wake_word=WAKE_WORD if SESSION["wake_word"] else None,
+                detector=detector,
+                prompts={
+                    "wake_word": WAKE_WORD_PROMPT,
+                    "wake_word_detected": WAKE_WORD_DETECTED,
+                    "start": CONVERSATION_START,
+                },
+                assistant=WAKE_WORD,
+                barge_in=SESSION["barge_in"],
+                traced=SESSION["debug"],
+            )
         else:
-            text = "Starting conversation"
-        speak.speak(text)
-        status_indicator.write(f"{text}")
+            # the webrtc component is rendered again on every run
+            session.listener = listen
+            session.traced = SESSION["debug"]
+            status_indicator.write(CONVERSATION_RESUMED)
 
-        # Conversation Loop
+        # Show the turns from before the rerun
+        for record in SESSION["transcript"].records():
+            st.text(f"{record['speaker']}:")
+            st.text(record["text"])
+
+        # Conversation view
+        response_text = None
+        clips = deque()
         with st.spinner("**Conversation**"):
-            while SESSION["run_app"]:
-                # Record audio until the speaker stops speaking
-                status_indicator.write("I am listening to you")
-                command = listen.listen(number_of_chunks=15000)
-                if command is None:
-                    status_indicator.write("Sorry, I didn't understand this")
+            while SESSION["run_app"] and session.running:
+                # the pool must not close the engines of the running conversation
+                for engine in pooled:
+                    ENGINES.touch(*engine)
+                # clips play one after the other, events are read meanwhile
+                timeout = 1
+                if clips:
+                    timeout = min(timeout, max(0, speak.playing_until - time.time()))
+                    if timeout == 0:
+                        speak.play(*clips.popleft())
+                        continue
+                event = session.next_event(timeout=timeout)
+                if event is None:
                     continue
-
-                # Display the transcribed text
-                status_indicator.write(f'I am processing your command: "*{command}*"')
-                st.text("You:")
-                st.text(command)
-                SESSION["conversation"].append(f"You: {command}")
-
-                # Get chatbot response and play it
-                response = chat.chat(command)
-                st.text("Jarvis:")
-                st.text(response)
-                SESSION["conversation"].append(f"Jarvis: {response}")
-                speak.speak(response)
-
-                # Download conversation button
-                with st.sidebar:
-                    file = "\n".join(SESSION["conversation"])
-                    file_name = f"jaivus_conversation_{str(datetime.now())}.txt"
-                    download_str = download_button(
-                        file, file_name, "Download conversation"
-                    )
-                    dowload_button.write(download_str, unsafe_allow_html=True)
+                kind, value = event
+                if kind == "status":
+                    status_indicator.write(value)
+                elif kind == "user":
+                    st.text("You:")
+                    st.text(value)
+                    st.text("Jarvis:")
+                    response_text = st.empty()
+                    response = ""
+                elif kind == "delta":
+                    if response_text is None:
+                        response_text = st.empty()
+                        response = ""
+                    response += value
+                    response_text.text(response)
+                elif kind == "assistant":
+                    response_text = None
+                elif kind == "audio":
+                    clips.append(value)
+                elif kind == "interrupt":
+                    # the user talks over the answer, its audio stops right away
+                    clips.clear()
+                    speak.stop()
+                    response_text = None
+                elif kind == "turn" and SESSION["debug"]:
+                    show_debug_panel(debug_panel, session_id)
+                elif kind == "error":
+                    st.error(value, icon="🚨")
 
 except Exception as e:
     # Error handling
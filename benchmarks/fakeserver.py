@@ -0,0 +1,99 @@
+"""Local stand-in for the speech recognition, OpenAI completions and TTS APIs.
+
+Every response is delayed by a configurable latency, the server runs in its
+own process so its CPU time is not counted against the pipeline.
+"""
+
+import json
+import multiprocessing
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TRANSCRIPT = "what is the weather like today"
+RESPONSE = (
+    "It is sunny with a light breeze. Temperatures stay mild all afternoon. "
+    "Expect a few clouds in the evening."
+)
+# MPEG 1 layer III frame header, 128 kbit/s at 44.1 kHz, 417 bytes per frame
+MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+MP3_FRAME_DURATION = 1152 / 44100
+WORDS_PER_SECOND = 2.5
+
+
+def synthetic_mp3(text):
+    # silent mp3 as long as the text takes to speak
+    duration = len(text.split()) / WORDS_PER_SECOND
+    return MP3_FRAME * max(1, round(duration / MP3_FRAME_DURATION))
+
+
+class Handler(BaseHTTPRequestHandler):
+    # latencies in seconds, set by serve
+    latency = {"stt": 0.3, "chat": 0.5, "token": 0.02, "tts": 0.2}
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type="application/json"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/tts":
+            self.send_error(404)
+            return
+        time.sleep(self.latency["tts"])
+        text = parse_qs(url.query).get("text", [""])[0]
+        self._send(synthetic_mp3(text), "audio/mpeg")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/recognize"):
+            time.sleep(self.latency["stt"])
+            self._send(json.dumps({"transcript": TRANSCRIPT}).encode())
+        elif self.path.startswith("/completions"):
+            self.complete(json.loads(body))
+        else:
+            self.send_error(404)
+
+    def complete(self, payload):
+        time.sleep(self.latency["chat"])
+        if not payload.get("stream"):
+            prompts = payload["prompt"]
+            if not isinstance(prompts, list):
+                prompts = [prompts]
+            choices = [{"index": i, "text": RESPONSE} for i in range(len(prompts))]
+            self._send(json.dumps({"choices": choices}).encode())
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for i, word in enumerate(RESPONSE.split(" ")):
+            if i:
+                time.sleep(self.latency["token"])
+            chunk = {"choices": [{"index": 0, "text": (" " if i else "") + word}]}
+            self.wfile.write(b"data: " + json.dumps(chunk).encode() + b"\n\n")
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+def serve(latency, ports):
+    Handler.latency = latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def start(**latency):
+    # starts the server process, returns its url and the process
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve, args=(dict(Handler.latency, **latency), ports), daemon=True
+    )
+    process.start()
+    return f"http://127.0.0.1:{ports.get(timeout=10)}", process
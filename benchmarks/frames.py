@@ -0,0 +1,43 @@
+import numpy as np
+
+
+class _Format:
+    def __init__(self, name, sample_width, is_planar):
+        self.name = name
+        self.bytes = sample_width
+        self.is_planar = is_planar
+
+
+class _Layout:
+    def __init__(self, channels):
+        self.channels = tuple(f"c{i}" for i in range(channels))
+
+
+class SyntheticAudioFrame:
+    """Stand-in for av.AudioFrame as delivered by streamlit_webrtc (packed s16)."""
+
+    format = _Format("s16", 2, False)
+
+    def __init__(self, samples, sample_rate, pts=None):
+        # samples: (n, channels) int16 array
+        self._samples = samples
+        self.samples = len(samples)
+        self.sample_rate = sample_rate
+        self.layout = _Layout(samples.shape[1])
+        self.pts = pts
+
+    def to_ndarray(self):
+        return self._samples.reshape(1, -1)
+
+
+def synthetic_frames(
+    duration, sample_rate=48000, channels=2, frame_duration=20, seed=0
+):
+    # duration and frame_duration in milliseconds
+    rng = np.random.default_rng(seed)
+    samples_per_frame = int(sample_rate * frame_duration / 1000)
+    for i in range(int(duration / frame_duration)):
+        samples = rng.integers(
+            -3000, 3000, size=(samples_per_frame, channels), dtype=np.int16
+        )
+        yield SyntheticAudioFrame(samples, sample_rate, pts=i * samples_per_frame)
@@ -0,0 +1,106 @@
+"""Cold start import time and resident memory per backend configuration.
+
+Every run imports the jaivus modules and the packages the selected chat,
+listener and speaker backends import when they are created, in a fresh
+interpreter under `python -X importtime`. Reports the median wall time, the
+import time of the slowest top level packages and the peak RSS.
+
+Run from the repository root: python -m benchmarks.imports
+"""
+
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+CORE_MODULES = ["jaivus.chat", "jaivus.listen", "jaivus.speak", "jaivus.runtime"]
+# packages imported by a backend when it is created
+BACKEND_MODULES = {
+    "openai": [],
+    "pychatgpt": ["pyChatGPT"],
+    "revchatgpt": ["revChatGPT.Official"],
+    "web": ["streamlit", "streamlit_webrtc", "jaivus.patch"],
+    "local": [],
+    "gtts": ["gtts"],
+    "pyttsx3": ["pyttsx3"],
+}
+CONFIGS = {
+    "core": [],
+    "openai,web,gtts": ["openai", "web", "gtts"],
+    "openai,local,pyttsx3": ["openai", "local", "pyttsx3"],
+    "all backends": list(BACKEND_MODULES),
+}
+CHILD = """
+import importlib, json, resource, sys, time
+t = time.perf_counter()
+missing = []
+for module in {modules!r}:
+    try:
+        importlib.import_module(module)
+    except Exception:
+        missing.append(module)
+print(json.dumps({{
+    "time": time.perf_counter() - t,
+    "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+    "modules": len(sys.modules),
+    "missing": missing,
+}}))
+"""
+IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def top_level_imports(stderr):
+    # cumulative microseconds of the packages imported at the top level
+    times = {}
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match and len(match.group(3)) <= 1:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+
+def measure(modules):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD.format(modules=modules)],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(process.stdout.splitlines()[-1])
+    result["imports"] = top_level_imports(process.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=3)
+    args = parser.parse_args()
+
+    print(
+        f"{'config':>22} {'import ms':>10} {'rss MiB':>8} {'modules':>8}"
+        f"  slowest packages"
+    )
+    for config in args.configs:
+        modules = CORE_MODULES + [
+            module for backend in CONFIGS[config] for module in BACKEND_MODULES[backend]
+        ]
+        results = [measure(modules) for _ in range(args.repeat)]
+        wall = statistics.median(result["time"] for result in results)
+        rss = statistics.median(result["rss"] for result in results)
+        imports = results[-1]["imports"]
+        slowest = sorted(imports, key=imports.get, reverse=True)[: args.top]
+        print(
+            f"{config:>22} {wall * 1000:>10.0f} {rss:>8.1f}"
+            f" {results[-1]['modules']:>8}  "
+            + ", ".join(f"{name} {imports[name] / 1000:.0f} ms" for name in slowest)
+        )
+        if results[-1]["missing"]:
+            print(f"{'':>22} not installed: {', '.join(results[-1]['missing'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Compare the pydub accumulator with the ring buffer of the listeners' endpointer.
+
+Run from the repository root: python -m benchmarks.listen_buffer
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pydub
+
+from benchmarks.frames import synthetic_frames
+from jaivus.audio import AudioBuffer
+
+
+def pydub_path(frames, window):
+    sound_chunk = pydub.AudioSegment.empty()
+    for audio_frame in frames:
+        sound = pydub.AudioSegment(
+            data=audio_frame.to_ndarray().tobytes(),
+            sample_width=audio_frame.format.bytes,
+            frame_rate=audio_frame.sample_rate,
+            channels=len(audio_frame.layout.channels),
+        )
+        sound_chunk += sound
+    sample_rate = frames[0].sample_rate
+    sound_chunk = sound_chunk.set_channels(1).set_frame_rate(sample_rate)
+    return np.array(sound_chunk.get_array_of_samples())
+
+
+def buffer_path(frames, window):
+    buffer = AudioBuffer(
+        window,
+        frames[0].sample_rate,
+        channels=len(frames[0].layout.channels),
+        dtype=frames[0].to_ndarray().dtype,
+    )
+    for audio_frame in frames:
+        buffer.write_frame(audio_frame)
+    return buffer.read()
+
+
+def measure(function, frames, window):
+    tracemalloc.start()
+    t = time.perf_counter()
+    function(frames, window)
+    duration = time.perf_counter() - t
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(frames) / duration, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--windows", type=int, nargs="+", default=[5, 15, 60])
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--channels", type=int, default=2)
+    args = parser.parse_args()
+
+    print(f"{'window':>8} {'path':>8} {'frames/s':>12} {'peak MiB':>10}")
+    for seconds in args.windows:
+        window = seconds * 1000
+        frames = list(synthetic_frames(window, args.sample_rate, args.channels))
+        for name, function in [("pydub", pydub_path), ("buffer", buffer_path)]:
+            rate, peak = measure(function, frames, window)
+            print(f"{seconds:>7}s {name:>8} {rate:>12.0f} {peak / 2**20:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
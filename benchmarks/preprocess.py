@@ -0,0 +1,76 @@
+"""Bytes sent and latency per utterance with and without recognizer preprocessing.
+
+Run from the repository root: python -m benchmarks.preprocess
+Pass --recognize to also time the Google recognizer round trip (needs network).
+"""
+
+import argparse
+import time
+
+import numpy as np
+import speech_recognition as sr
+
+from jaivus.audio import preprocess
+from jaivus.listen import SUPPORTED_RECOGNIZER
+
+
+def synthetic_utterance(duration, sample_rate=48000, seed=0):
+    # voiced harmonics with a syllable envelope over background noise, in seconds
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    pitch = 150 + 30 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 20))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    samples = 6000 * envelope * voice + rng.normal(0, 200, len(t))
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+
+def measure(samples, sample_rate, preprocessing, recognizer=None):
+    t = time.perf_counter()
+    samples, sample_rate = preprocess(samples, sample_rate, **preprocessing)
+    audio = sr.AudioData(samples.tobytes(), sample_rate, 2)
+    preprocess_time = time.perf_counter() - t
+    t = time.perf_counter()
+    # recognize_google uploads flac at the rate of the audio data
+    flac = audio.get_flac_data()
+    encode_time = time.perf_counter() - t
+    round_trip = None
+    if recognizer is not None:
+        t = time.perf_counter()
+        try:
+            recognizer.recognize_google(audio)
+        except (sr.UnknownValueError, sr.RequestError):
+            pass
+        round_trip = time.perf_counter() - t
+    return len(audio.frame_data), len(flac), preprocess_time, encode_time, round_trip
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--durations", type=float, nargs="+", default=[2, 5, 15])
+    parser.add_argument("--sample-rate", type=int, default=48000)
+    parser.add_argument("--recognize", action="store_true")
+    args = parser.parse_args()
+
+    recognizer = sr.Recognizer() if args.recognize else None
+    configs = [("raw", {}), ("google", SUPPORTED_RECOGNIZER["google"])]
+    print(
+        f"{'utterance':>9} {'config':>8} {'pcm KiB':>9} {'flac KiB':>9}"
+        f" {'prep ms':>8} {'flac ms':>8} {'rtt ms':>8}"
+    )
+    for duration in args.durations:
+        samples = synthetic_utterance(duration, args.sample_rate)
+        for name, preprocessing in configs:
+            pcm, flac, prep, encode, rtt = measure(
+                samples, args.sample_rate, preprocessing, recognizer
+            )
+            rtt = "-" if rtt is None else f"{rtt * 1000:.0f}"
+            print(
+                f"{duration:>8.0f}s {name:>8} {pcm / 2**10:>9.1f} {flac / 2**10:>9.1f}"
+                f" {prep * 1000:>8.1f} {encode * 1000:>8.1f} {rtt:>8}"
+            )
+
+
+if __name__ == "__main__":
+    main()
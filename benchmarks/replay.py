@@ -0,0 +1,261 @@
+"""Replay recorded or synthetic utterances through the listen, chat and speak pipeline.
+
+Every session runs on the shared Runtime like the app's sessions do, audio is
+fed in real time (or --speed times faster) through the frame path of
+WebListener, recognition, completions and TTS go to a local stand-in server
+with configurable latency. A view thread per session reads the session's
+events and times the stages. Reports per stage and end-to-end latency,
+throughput, CPU and peak RSS for N concurrent sessions.
+
+Run from the repository root: python -m benchmarks.replay --sessions 1 4 16
+"""
+
+import argparse
+import resource
+import threading
+import time
+from urllib.parse import quote
+
+import numpy as np
+import requests
+
+from benchmarks import fakeserver
+from benchmarks.frames import SyntheticAudioFrame
+from benchmarks.preprocess import synthetic_utterance
+from jaivus.audio import read_wav, resample_poly
+from jaivus.chat import Conversation, OpenAIBot
+from jaivus.listen import QUEUE_SIZE, WebListener
+from jaivus.receiver import FrameRing
+from jaivus.runtime import get_runtime
+from jaivus.speak import PipelinedSpeaker
+
+SAMPLE_RATE = 48000
+FRAME_DURATION = 20
+STAGES = ["listen", "stt", "first_token", "response", "first_audio", "turn"]
+EVENT_TIMEOUT = 60
+
+
+def to_frames(samples, sample_rate):
+    # 48 kHz stereo frames of 20 ms, like browsers send them over webrtc
+    samples = resample_poly(samples, sample_rate, SAMPLE_RATE)
+    samples = np.repeat(samples.reshape(-1, 1), 2, axis=1)
+    frame_length = SAMPLE_RATE * FRAME_DURATION // 1000
+    return [
+        SyntheticAudioFrame(samples[i : i + frame_length], SAMPLE_RATE, pts=i)
+        for i in range(0, len(samples) - frame_length + 1, frame_length)
+    ]
+
+
+class ReplayStreamer:
+    """Stands in for jaivus.listen.Streamer, plays an utterance per turn.
+
+    The utterance is followed by background noise until `stop` is called,
+    frames are put into the same FrameRing the webrtc receiver uses.
+    """
+
+    playing = True
+
+    def __init__(self, utterance, noise, speed=1.0):
+        self.utterance = utterance
+        self.noise = noise
+        self.speed = speed
+        self.frames = FrameRing(QUEUE_SIZE)
+        self.speech_end = None
+        self._stop = threading.Event()
+        self._producer = None
+
+    @property
+    def stats(self):
+        return self.frames.stats
+
+    def empty(self):
+        # the session starts listening, the user starts speaking
+        self.stop()
+        self.frames.clear()
+        self.speech_end = None
+        self._stop.clear()
+        self._producer = threading.Thread(target=self._produce, daemon=True)
+        self._producer.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._producer is not None:
+            self._producer.join()
+
+    def _produce(self):
+        start = time.time()
+        interval = FRAME_DURATION / 1000 / self.speed
+        i = 0
+        while not self._stop.is_set():
+            if i < len(self.utterance):
+                frame = self.utterance[i]
+            else:
+                frame = self.noise[(i - len(self.utterance)) % len(self.noise)]
+            self.frames.put(frame)
+            i += 1
+            if i == len(self.utterance):
+                self.speech_end = time.time()
+            delay = start + i * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def get_frames(self, timeout=1):
+        return self.frames.drain(timeout=timeout)
+
+
+class ReplayRecognizer:
+    """Stands in for speech_recognition's Google recognizer, uploads flac."""
+
+    def __init__(self, url):
+        self.url = url
+        self.energy_threshold = 300
+        self.times = []
+
+    def recognize_google(self, audio, **kwargs):
+        t = time.time()
+        response = requests.post(
+            f"{self.url}/recognize",
+            data=audio.get_flac_data(),
+            headers={"Content-Type": f"audio/x-flac; rate={audio.sample_rate}"},
+        )
+        self.times.append(time.time() - t)
+        return response.json()["transcript"]
+
+
+class ReplaySpeaker(PipelinedSpeaker):
+    """Synthesizes with the stand-in TTS endpoint, the view drops the audio."""
+
+    def __init__(self, url, cache=None):
+        super(ReplaySpeaker, self).__init__(cache)
+        self.url = url
+        self.http = requests.Session()
+
+    def synthesize(self, text):
+        response = self.http.get(f"{self.url}/tts?text={quote(text)}")
+        return response.content
+
+
+def next_turn(session, streamer):
+    # reads the events of one turn, returns the time of the first of each kind
+    times = {}
+    while "assistant" not in times:
+        event = session.next_event(timeout=EVENT_TIMEOUT)
+        if event is None:
+            raise TimeoutError(f"no event for {EVENT_TIMEOUT} seconds")
+        kind, value = event
+        if kind == "error":
+            raise RuntimeError(value)
+        if kind == "user":
+            # the utterance is recognized, the user stops making noise
+            streamer.stop()
+        if kind == "delta":
+            times["last_delta"] = time.time()
+        times.setdefault(kind, time.time())
+    return times
+
+
+def run_session(runtime, session_id, url, utterance, noise, turns, speed, results):
+    streamer = ReplayStreamer(utterance, noise, speed)
+    listener = WebListener("google", streamer=streamer)
+    listener.recognizer = ReplayRecognizer(url)
+    speaker = ReplaySpeaker(url)
+    session = runtime.start_session(
+        session_id,
+        listener=listener,
+        chatbot=OpenAIBot({"api_key": "replay", "api_base": url}),
+        speaker=speaker,
+        conversation=Conversation(),
+    )
+    try:
+        for _ in range(turns):
+            dropped = streamer.stats["dropped"]
+            times = next_turn(session, streamer)
+            heard = times["user"]
+            speech_end = streamer.speech_end
+            results.append(
+                {
+                    "listen": heard - speech_end,
+                    "stt": listener.recognizer.times[-1],
+                    "first_token": times["delta"] - heard,
+                    "response": times["last_delta"] - heard,
+                    "first_audio": times["audio"] - speech_end,
+                    "turn": times["assistant"] - speech_end,
+                    "dropped": streamer.stats["dropped"] - dropped,
+                }
+            )
+    finally:
+        runtime.stop_session(session_id)
+        streamer.stop()
+        speaker.close()
+
+
+def run(url, utterance, noise, sessions, turns, speed):
+    runtime = get_runtime()
+    results = []
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    t = time.time()
+    threads = [
+        threading.Thread(
+            target=run_session,
+            args=(runtime, f"replay-{i}", url, utterance, noise, turns, speed, results),
+        )
+        for i in range(sessions)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - t
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = end.ru_utime - usage.ru_utime + end.ru_stime - usage.ru_stime
+    return results, wall, cpu, end.ru_maxrss / 2**10
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--wav", help="16 bit wav fixture, default synthetic speech")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--stt-latency", type=float, default=0.3)
+    parser.add_argument("--chat-latency", type=float, default=0.5)
+    parser.add_argument("--token-latency", type=float, default=0.02)
+    parser.add_argument("--tts-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    url, server = fakeserver.start(
+        stt=args.stt_latency,
+        chat=args.chat_latency,
+        token=args.token_latency,
+        tts=args.tts_latency,
+    )
+    if args.wav:
+        samples, sample_rate = read_wav(args.wav)
+    else:
+        samples, sample_rate = synthetic_utterance(2, SAMPLE_RATE), SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    noise = rng.normal(0, 100, sample_rate).astype(np.int16)
+    utterance = to_frames(samples, sample_rate)
+    noise = to_frames(noise, sample_rate)
+
+    print(
+        f"{'sessions':>8} {'stage':>12} {'p50 ms':>8} {'p95 ms':>8}"
+        f" {'turns/s':>8} {'cpu %':>6} {'rss MiB':>8} {'dropped':>8}"
+    )
+    for sessions in args.sessions:
+        results, wall, cpu, rss = run(
+            url, utterance, noise, sessions, args.turns, args.speed
+        )
+        for stage in STAGES:
+            values = [result[stage] * 1000 for result in results]
+            print(
+                f"{sessions:>8} {stage:>12} {np.percentile(values, 50):>8.0f}"
+                f" {np.percentile(values, 95):>8.0f} {len(results) / wall:>8.2f}"
+                f" {cpu / wall * 100:>6.0f} {rss:>8.1f}"
+                f" {sum(result['dropped'] for result in results):>8}"
+            )
+    server.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import functools
+import logging
+import math
+import wave
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DOWNMIX_BLOCK_SIZE = 65536
+RESAMPLE_BLOCK_SIZE = 16384
+
+
+def frame_to_ndarray(audio_frame):
+    # av packs interleaved samples as (1, samples * channels) and planar samples
+    # as (channels, samples), both are returned as a (samples, channels) view
+    array = audio_frame.to_ndarray()
+    channels = len(audio_frame.layout.channels)
+    if audio_frame.format.is_planar:
+        return array.T
+    return array.reshape(-1, channels)
+
+
+def downmix(samples):
+    if samples.ndim == 1:
+        return samples
+    if samples.shape[1] == 1:
+        return samples[:, 0]
+    channels = samples.shape[1]
+    if not np.issubdtype(samples.dtype, np.integer):
+        return samples.mean(axis=1, dtype=samples.dtype)
+    # integer downmix in blocks keeps the temporary copy small
+    mono = np.empty(len(samples), dtype=samples.dtype)
+    for start in range(0, len(samples), DOWNMIX_BLOCK_SIZE):
+        block = samples[start : start + DOWNMIX_BLOCK_SIZE]
+        total = block[:, 0].astype(np.int32)
+        for channel in range(1, channels):
+            total += block[:, channel]
+        total += channels // 2
+        total //= channels
+        mono[start : start + len(block)] = total
+    return mono
+
+
+def resample(samples, sample_rate, target_rate):
+    if sample_rate == target_rate or len(samples) == 0:
+        return samples
+    length = int(round(len(samples) * target_rate / sample_rate))
+    positions = np.arange(length) * (sample_rate / target_rate)
+    resampled = np.interp(positions, np.arange(len(samples)), samples)
+    if np.issubdtype(samples.dtype, np.integer):
+        resampled = np.round(resampled)
+    return resampled.astype(samples.dtype)
+
+
+@functools.lru_cache(maxsize=8)
+def polyphase_filter(up, down, zeros=8, beta=5.0):
+    # kaiser windowed sinc low pass for resampling by up / down, split into
+    # `up` phases of `taps` coefficients each
+    factor = max(up, down)
+    n = np.arange(-zeros * factor, zeros * factor + 1)
+    h = np.sinc(n / factor) * np.kaiser(len(n), beta) * up / factor
+    taps = -(-len(h) // up)
+    h = np.pad(h, (0, taps * up - len(h)))
+    return h.reshape(taps, up).T.astype(np.float32), zeros * factor
+
+
+def resample_poly(samples, sample_rate, target_rate):
+    """Resamples mono samples by a rational factor with a polyphase filter.
+
+    Unlike `resample` the signal is low pass filtered first, so downsampling
+    does not alias. Output samples are computed in blocks, every sample is a
+    dot product of one filter phase with the input around it.
+    """
+    if sample_rate == target_rate or len(samples) == 0:
+        return samples
+    gcd = math.gcd(sample_rate, target_rate)
+    up, down = target_rate // gcd, sample_rate // gcd
+    phases, delay = polyphase_filter(up, down)
+    taps = phases.shape[1]
+    padded = np.pad(samples.astype(np.float32), (taps, taps))
+    length = -(-len(samples) * up // down)
+    resampled = np.empty(length, dtype=np.float32)
+    offsets = taps - np.arange(taps)
+    for start in range(0, length, RESAMPLE_BLOCK_SIZE):
+        # position of the output samples in the upsampled signal
+        position = np.arange(start, min(start + RESAMPLE_BLOCK_SIZE, length))
+        position = position * down + delay
+        window = padded[(position // up)[:, None] + offsets]
+        resampled[start : start + len(position)] = np.einsum(
+            "ij,ij->i", window, phases[position % up]
+        )
+    if np.issubdtype(samples.dtype, np.integer):
+        info = np.iinfo(samples.dtype)
+        resampled = np.clip(np.round(resampled), info.min, info.max)
+    return resampled.astype(samples.dtype)
+
+
+def highpass(samples, sample_rate, cutoff=80):
+    # removes dc offset and rumble below about `cutoff` Hz by subtracting the
+    # moving average over one period of the cutoff frequency
+    width = max(1, int(sample_rate / cutoff))
+    if len(samples) < width:
+        return samples
+    cumsum = np.cumsum(
+        np.pad(
+            samples.astype(np.float64),
+            (width // 2, width - 1 - width // 2),
+            mode="edge",
+        )
+    )
+    average = (cumsum[width - 1 :] - np.concatenate(([0], cumsum[:-width]))) / width
+    filtered = samples - average
+    if np.issubdtype(samples.dtype, np.integer):
+        info = np.iinfo(samples.dtype)
+        filtered = np.clip(np.round(filtered), info.min, info.max)
+    return filtered.astype(samples.dtype)
+
+
+def noise_gate(samples, sample_rate, threshold, frame_duration=20):
+    # zeroes frames with a root mean square energy below the threshold
+    frame_length = max(1, int(sample_rate * frame_duration / 1000))
+    frames = len(samples) // frame_length
+    if frames == 0:
+        return samples
+    gated = samples.copy()
+    blocks = gated[: frames * frame_length].reshape(frames, frame_length)
+    energy = np.sqrt(np.mean(np.square(blocks, dtype=np.float64), axis=1))
+    blocks[energy < threshold] = 0
+    if energy[-1] < threshold:
+        gated[frames * frame_length :] = 0
+    return gated
+
+
+def preprocess(
+    samples, sample_rate, target_rate=None, highpass_cutoff=None, gate_threshold=None
+):
+    """Prepares mono samples for a recognizer, returns the samples and their rate."""
+    if target_rate is not None and target_rate < sample_rate:
+        samples = resample_poly(samples, sample_rate, target_rate)
+        sample_rate = target_rate
+    if highpass_cutoff is not None:
+        samples = highpass(samples, sample_rate, highpass_cutoff)
+    if gate_threshold is not None:
+        samples = noise_gate(samples, sample_rate, gate_threshold)
+    return samples, sample_rate
+
+
+class AudioBuffer:
+    """Preallocated ring buffer of interleaved PCM samples.
+
+    Frames are copied once into a fixed array, downmixing and resampling
+    happen in bulk when the buffer is read. Once the buffer is full the
+    oldest samples are overwritten.
+    """
+
+    def __init__(self, duration, sample_rate, channels=1, dtype=np.int16):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.capacity = int(duration / 1000 * sample_rate)
+        self._data = np.zeros((self.capacity, channels), dtype=dtype)
+        self._start = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    @property
+    def sample_width(self):
+        return self._data.dtype.itemsize
+
+    @property
+    def duration(self):
+        # buffered audio in milliseconds, like len() of a pydub.AudioSegment
+        return self._size / self.sample_rate * 1000
+
+    @property
+    def full(self):
+        return self._size == self.capacity
+
+    def clear(self):
+        self._start = 0
+        self._size = 0
+
+    def write(self, samples):
+        samples = samples.reshape(len(samples), self.channels)
+        if len(samples) >= self.capacity:
+            self._data[:] = samples[len(samples) - self.capacity :]
+            self._start = 0
+            self._size = self.capacity
+            return
+        end = (self._start + self._size) % self.capacity
+        head = min(len(samples), self.capacity - end)
+        self._data[end : end + head] = samples[:head]
+        self._data[: len(samples) - head] = samples[head:]
+        overflow = self._size + len(samples) - self.capacity
+        if overflow > 0:
+            self._start = (self._start + overflow) % self.capacity
+        self._size = min(self._size + len(samples), self.capacity)
+
+    def write_frame(self, audio_frame):
+        self.write(frame_to_ndarray(audio_frame))
+
+    def samples(self):
+        end = self._start + self._size
+        if end <= self.capacity:
+            return self._data[self._start : end]
+        return np.concatenate(
+            (self._data[self._start :], self._data[: end - self.capacity])
+        )
+
+    def read(self, sample_rate=None):
+        # returns the buffered audio as a contiguous mono array
+        samples = downmix(self.samples())
+        if sample_rate is not None:
+            samples = resample(samples, self.sample_rate, sample_rate)
+        return np.ascontiguousarray(samples)
+
+
+def read_wav(path):
+    # returns the mono samples and the sample rate of a 16 bit wav file
+    with wave.open(path, "rb") as wav:
+        assert wav.getsampwidth() == 2, "only 16 bit wav files are supported"
+        data = wav.readframes(wav.getnframes())
+        samples = np.frombuffer(data, dtype=np.int16)
+        samples = samples.reshape(-1, wav.getnchannels())
+        return downmix(samples), wav.getframerate()
+
+
+@functools.lru_cache(maxsize=8)
+def mel_filterbank(n_filters, n_fft, sample_rate):
+    def hz_to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+
+    def mel_to_hz(mel):
+        return 700 * (10 ** (mel / 2595) - 1)
+
+    mels = np.linspace(0, hz_to_mel(sample_rate / 2), n_filters + 2)
+    bins = np.floor((n_fft + 1) * mel_to_hz(mels) / sample_rate).astype(int)
+    filterbank = np.zeros((n_filters, n_fft // 2 + 1), dtype=np.float32)
+    for i in range(n_filters):
+        left, center, right = bins[i], bins[i + 1], bins[i + 2]
+        if center > left:
+            filterbank[i, left:center] = np.linspace(0, 1, center - left, False)
+        if right > center:
+            filterbank[i, center:right] = np.linspace(1, 0, right - center, False)
+    return filterbank
+
+
+@functools.lru_cache(maxsize=8)
+def dct_matrix(n_input, n_output):
+    # orthonormal DCT-II basis
+    n = np.arange(n_input)
+    k = np.arange(n_output)[:, None]
+    matrix = np.cos(np.pi * k * (2 * n + 1) / (2 * n_input)) * np.sqrt(2 / n_input)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+def mfcc(
+    samples,
+    sample_rate,
+    n_mfcc=13,
+    n_filters=26,
+    frame_length=25,
+    frame_step=10,
+    n_fft=512,
+):
+    # frame_length and frame_step in milliseconds, returns (frames, n_mfcc)
+    signal = samples.astype(np.float32) / 32768
+    signal = np.append(signal[:1], signal[1:] - 0.97 * signal[:-1])
+    length = int(sample_rate * frame_length / 1000)
+    step = int(sample_rate * frame_step / 1000)
+    if len(signal) < length:
+        signal = np.pad(signal, (0, length - len(signal)))
+    frames = np.lib.stride_tricks.sliding_window_view(signal, length)[::step]
+    frames = frames * np.hamming(length).astype(np.float32)
+    power = np.abs(np.fft.rfft(frames, n_fft)) ** 2 / n_fft
+    energies = power @ mel_filterbank(n_filters, n_fft, sample_rate).T
+    energies = np.log(np.maximum(energies, 1e-10))
+    return energies @ dct_matrix(n_filters, n_mfcc).T
+
+
+def subsequence_dtw(template, features):
+    """Cost of the best alignment of template with any span of features.
+
+    Both are (frames, dims) arrays. Steps advance one template frame and zero
+    to two feature frames, so the matched span may be up to twice as long as
+    the template. The cost is normalized by the template length.
+    """
+    distances = np.sqrt(
+        ((template[:, None, :] - features[None, :, :]) ** 2).sum(axis=-1)
+    )
+    cost = distances[0].copy()
+    for row in distances[1:]:
+        best = cost.copy()
+        best[1:] = np.minimum(best[1:], cost[:-1])
+        best[2:] = np.minimum(best[2:], cost[:-2])
+        cost = best + row
+    return cost.min() / len(template)
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    # stable digest of json serializable parts
+    data = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @property
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate, 3),
+        }
+
+    def count(self, value):
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+
+class LRUCache(CacheStats):
+    """Thread safe in-memory cache with LRU eviction.
+
+    The cache is bounded by the number of entries and, for values supporting
+    len(), by their total size. Entries older than `ttl` seconds expire.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=None):
+        super(LRUCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self):
+        stats = super(LRUCache, self).stats
+        stats.update(entries=len(self), bytes=self.size)
+        return stats
+
+    def _sizeof(self, value):
+        return len(value) if self.max_bytes is not None else 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, created = entry
+                if self.ttl is not None and time.time() - created > self.ttl:
+                    self._remove(key)
+                    entry = None
+                else:
+                    self._entries.move_to_end(key)
+            return self.count(entry and entry[0])
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.time())
+            self.size += self._sizeof(value)
+            while len(self._entries) > self.max_entries or (
+                self.max_bytes is not None and self.size > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        value, _ = self._entries.pop(key)
+        self.size -= self._sizeof(value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class DiskCache(CacheStats):
+    """Cache of bytes values stored as files in a directory.
+
+    The least recently used files are removed once the directory grows
+    beyond `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 2**20):
+        super(DiskCache, self).__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._files())
+
+    def _files(self):
+        return [entry for entry in os.scandir(self.directory) if entry.is_file()]
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                value = f.read()
+            # the access time drives the eviction order
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            value = None
+        return self.count(value)
+
+    def set(self, key, value):
+        # write to a temp file first, concurrent readers never see partial files
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(value)
+        with self._lock:
+            if os.path.exists(self._path(key)):
+                self.size -= os.path.getsize(self._path(key))
+            os.replace(path, self._path(key))
+            self.size += len(value)
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        files = sorted(
+            (entry for entry in self._files() if not entry.name.endswith(".tmp")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        for entry in files:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
+
+
+class TieredCache(CacheStats):
+    """Looks up the tiers in order and promotes hits to the faster tiers."""
+
+    def __init__(self, *tiers):
+        super(TieredCache, self).__init__()
+        self.tiers = tiers
+
+    @property
+    def stats(self):
+        stats = super(TieredCache, self).stats
+        stats["tiers"] = [tier.stats for tier in self.tiers]
+        return stats
+
+    def get(self, key):
+        value = None
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                break
+        return self.count(value)
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+
+class SQLiteCache(CacheStats):
+    """Persistent cache in a SQLite table with LRU eviction and optional TTL."""
+
+    def __init__(self, path, max_entries=10000, ttl=None):
+        super(SQLiteCache, self).__init__()
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value, created REAL, accessed REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS accessed ON cache (accessed)")
+        self._db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @property
+    def stats(self):
+        stats = super(SQLiteCache, self).stats
+        stats["entries"] = len(self)
+        return stats
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                row = None
+            elif row is not None:
+                self._db.execute(
+                    "UPDATE cache SET accessed = ? WHERE key = ?", (now, key)
+                )
+            self._db.commit()
+            return self.count(row and row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            self._db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM cache")
+            self._db.commit()
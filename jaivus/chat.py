@@ -1,71 +1,369 @@
+import asyncio
 import json
 import logging
+import re
+import time
+from collections import deque
 
-import openai
-from pyChatGPT import ChatGPT
-from revChatGPT.Official import Chatbot
+from jaivus.cache import LRUCache, SQLiteCache, cache_key
+from jaivus.client import API_BASE, OpenAIClient, get_dispatcher
+from jaivus.registry import Registry
+from jaivus.trace import TRACER
 
 logger = logging.getLogger(__name__)
 
-SUPPORTED_CHATBOTS = ["openai", "pychatgpt", "revchatgpt"]
+# backends are imported when selected, packages add more with "jaivus.chatbots" entry points
+CHATBOTS = Registry(
+    "jaivus.chatbots",
+    {
+        "openai": "jaivus.chat:OpenAIBot",
+        "pychatgpt": "jaivus.chat:PyChatGPTBot",
+        "revchatgpt": "jaivus.chat:RevPyChatGPTBot",
+    },
+)
+SUPPORTED_CHATBOTS = list(CHATBOTS.backends)
+SUMMARY_SNIPPET_TOKENS = 32
+# responses shared by all cached bots of the process
+RESPONSE_CACHE = LRUCache(max_entries=1024, ttl=24 * 3600)
 
+_encoding = None
 
-def get_chatbot(bot="openai", config="config.json"):
-    assert bot in SUPPORTED_CHATBOTS
-    if bot == "openai":
-        return OpenAIBot(config)
-    elif bot == "pychatgpt":
-        return PyChatGPTBot(config)
-    elif bot == "revchatgpt":
-        return RevPyChatGPTBot(config)
+
+def get_chatbot(bot="openai", config="config.json", cache=None):
+    assert bot in CHATBOTS
+    chatbot = CHATBOTS.load(bot)(config)
+    if cache is not None:
+        return CachedBot(chatbot, cache)
+    return chatbot
+
+
+def is_stateful(bot):
+    # stateful bots keep the conversation upstream, they serve a single user
+    return getattr(CHATBOTS.load(bot), "stateful", False)
+
+
+def get_response_cache(path=None, ttl=24 * 3600):
+    # in-memory cache, or a persistent sqlite cache if a path is given
+    if path is None:
+        return RESPONSE_CACHE
+    return SQLiteCache(path, ttl=ttl)
+
+
+def normalize_prompt(text):
+    # transcripts of the same question differ in case, punctuation and spacing
+    return " ".join(re.sub(r"[^\w\s']", " ", text.lower()).split())
+
+
+def count_tokens(text):
+    # exact with tiktoken if installed, otherwise about four characters per token
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+
+            _encoding = tiktoken.get_encoding("p50k_base")
+        except ImportError:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4 + 1
+
+
+class Conversation:
+    """Turns of a conversation and the prompt built from them.
+
+    Every turn is tokenized once when it is added. The most recent turns
+    are sent verbatim within `max_tokens`, older turns are folded into a
+    summary of their first sentences, capped at `summary_tokens`, so the
+    prompt size stays bounded however long the conversation grows.
+    """
+
+    def __init__(
+        self, max_tokens=2048, summary_tokens=256, user="You", assistant="Jarvis"
+    ):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.user = user
+        self.assistant = assistant
+        self.turns = deque()
+        self.turn_tokens = 0
+        self.summary = deque()
+        self.summary_tokens_used = 0
+
+    def __len__(self):
+        return len(self.turns) + len(self.summary)
+
+    @property
+    def tokens(self):
+        return self.turn_tokens + self.summary_tokens_used
+
+    def add(self, speaker, text):
+        line = f"{speaker}: {text.strip()}\n"
+        tokens = count_tokens(line)
+        self.turns.append((speaker, line, tokens))
+        self.turn_tokens += tokens
+        # the latest turn always stays verbatim
+        while self.tokens > self.max_tokens and len(self.turns) > 1:
+            self._fold(*self.turns.popleft())
+
+    def amend(self, speaker, text):
+        # replaces the last turn if it is the speaker's, e.g. an interrupted answer
+        if self.turns and self.turns[-1][0] == speaker:
+            self.turn_tokens -= self.turns.pop()[2]
+        if text:
+            self.add(speaker, text)
+
+    def _fold(self, speaker, line, tokens):
+        self.turn_tokens -= tokens
+        text = line[len(speaker) + 2 :].strip()
+        snippet = re.split(r"(?<=[.!?])\s", text, maxsplit=1)[0]
+        snippet_tokens = count_tokens(snippet)
+        if snippet_tokens > SUMMARY_SNIPPET_TOKENS:
+            snippet = snippet[: SUMMARY_SNIPPET_TOKENS * 4].rsplit(" ", 1)[0] + "..."
+            snippet_tokens = count_tokens(snippet)
+        snippet = f"{speaker} said: {snippet}\n"
+        self.summary.append((snippet, snippet_tokens + 3))
+        self.summary_tokens_used += snippet_tokens + 3
+        while self.summary_tokens_used > self.summary_tokens:
+            self.summary_tokens_used -= self.summary.popleft()[1]
+
+    def prompt(self):
+        # the prompt for the assistant's answer to the last turn
+        summary = ""
+        if self.summary:
+            summary = "Earlier in the conversation:\n" + "".join(
+                snippet for snippet, _ in self.summary
+            )
+        turns = "".join(line for _, line, _ in self.turns)
+        return f"{summary}{turns}{self.assistant}:"
+
+
+class CachedBot:
+    """Answers repeated prompts of a bot from a response cache.
+
+    Prompts are keyed on their normalized text and the bot's parameters.
+    The cache is bypassed when the answer depends on more than the prompt:
+    for sampling temperatures above `max_temperature`, for conversations
+    with earlier turns and for bots keeping their own context upstream. Only
+    deterministic answers are cached by default, sampled answers must vary.
+    """
+
+    def __init__(self, bot, cache=None, max_temperature=0):
+        self.bot = bot
+        self.cache = cache if cache is not None else RESPONSE_CACHE
+        self.max_temperature = max_temperature
+        self.bypassed = 0
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    @property
+    def stats(self):
+        return dict(self.cache.stats, bypassed=self.bypassed)
+
+    def cacheable(self, conversation):
+        parameters = getattr(self.bot, "parameters", {})
+        cacheable = (
+            parameters.get("temperature", 0) <= self.max_temperature
+            and not getattr(self.bot, "stateful", False)
+            and (conversation is None or len(conversation) == 0)
+        )
+        if not cacheable:
+            self.bypassed += 1
+        return cacheable
+
+    def key(self, prompt):
+        parameters = getattr(self.bot, "parameters", {})
+        return cache_key(type(self.bot).__name__, parameters, normalize_prompt(prompt))
+
+    def _hit(self, prompt, conversation):
+        text = self.cache.get(self.key(prompt))
+        if text is not None:
+            logger.info(f"cached response: {text}")
+            if conversation is not None:
+                conversation.add(conversation.user, prompt)
+                conversation.add(conversation.assistant, text)
+        return text
+
+    def chat(self, prompt, conversation=None):
+        if not self.cacheable(conversation):
+            return self.bot.chat(prompt, conversation)
+        text = self._hit(prompt, conversation)
+        if text is None:
+            text = self.bot.chat(prompt, conversation)
+            self.cache.set(self.key(prompt), text)
+        return text
+
+    async def achat(self, prompt, conversation=None):
+        if not self.cacheable(conversation):
+            return await self.bot.achat(prompt, conversation)
+        text = self._hit(prompt, conversation)
+        if text is None:
+            text = await self.bot.achat(prompt, conversation)
+            self.cache.set(self.key(prompt), text)
+        return text
+
+    def chat_stream(self, prompt, conversation=None):
+        if not self.cacheable(conversation):
+            yield from self.bot.chat_stream(prompt, conversation)
+            return
+        text = self._hit(prompt, conversation)
+        if text is not None:
+            yield text
+            return
+        text = ""
+        for delta in self.bot.chat_stream(prompt, conversation):
+            text += delta
+            yield delta
+        self.cache.set(self.key(prompt), text)
 
 
 class OpenAIBot:
     def __init__(self, config="config.json"):
         if isinstance(config, str):
             config = json.load(open(config))
-        openai.api_key = config["api_key"]
+        # the client owns the api key, sessions with different keys never collide
+        self.client = OpenAIClient(
+            config["api_key"],
+            api_base=config.get("api_base", API_BASE),
+            timeout=config.get("timeout", 60),
+            retries=config.get("retries", 3),
+            hedge_after=config.get("hedge_after"),
+        )
+        # concurrent sessions of the same account share batched requests
+        self.dispatcher = get_dispatcher(
+            self.client,
+            max_batch=config.get("max_batch", 16),
+            max_wait=config.get("max_batch_wait", 0.01),
+            requests_per_minute=config.get("requests_per_minute"),
+            tokens_per_minute=config.get("tokens_per_minute"),
+        )
         # Init openai parameters
         self.parameters = {}
-        self.parameters["engine"] = config.get("engine", "text-davinci-003")
+        self.parameters["model"] = config.get("engine", "text-davinci-003")
         self.parameters["temperature"] = config.get("temperature", 0.5)
         self.parameters["max_tokens"] = config.get("max_tokens", 1024)
         self.parameters["top_p"] = config.get("top_p", 1)
         self.parameters["frequency_penalty"] = config.get("frequency_penalty", 0)
         self.parameters["presence_penalty"] = config.get("presence_penalty", 0)
 
-    def chat(self, prompt):
+    def _prompt(self, prompt, conversation):
+        if conversation is None:
+            return prompt
+        conversation.add(conversation.user, prompt)
+        return conversation.prompt()
+
+    def _record(self, text, conversation):
+        if conversation is not None:
+            conversation.add(conversation.assistant, text)
+        return text
+
+    def chat(self, prompt, conversation=None):
+        logger.info("start chat")
+        with TRACER.span("chat"):
+            response = self.dispatcher.complete(
+                self._prompt(prompt, conversation),
+                **self.parameters,
+            )
+        logger.info(f"response: {response}")
+        return self._record(response["choices"][0]["text"], conversation)
+
+    async def achat(self, prompt, conversation=None):
+        # the request is batched by the dispatcher, the event loop is not blocked
         logger.info("start chat")
-        response = openai.Completion.create(
-            prompt=prompt,
-            **self.parameters,
+        response = await asyncio.wrap_future(
+            self.dispatcher.submit(
+                self._prompt(prompt, conversation), **self.parameters
+            )
         )
         logger.info(f"response: {response}")
-        return response["choices"][0]["text"]
+        return self._record(response["choices"][0]["text"], conversation)
+
+    def chat_stream(self, prompt, conversation=None):
+        # yields the completion text in deltas as it is generated
+        logger.info("start chat")
+        t = time.time()
+        response = self.dispatcher.stream(
+            self._prompt(prompt, conversation), **self.parameters
+        )
+        text = ""
+        for chunk in response:
+            delta = chunk["choices"][0]["text"]
+            if not text:
+                TRACER.record("chat_first_token", time.time() - t)
+            text += delta
+            yield delta
+        TRACER.record("chat_stream", time.time() - t)
+        self._record(text, conversation)
+        logger.info("stop chat")
 
 
 class PyChatGPTBot:
+    # the conversation context lives upstream, answers depend on it
+    stateful = True
+
     def __init__(self, config="config.json"):
+        from pyChatGPT import ChatGPT
+
         if isinstance(config, str):
             config = json.load(open(config))
         self.bot = ChatGPT(config["session_token"])
         self.bot.reset_conversation()
 
-    def chat(self, prompt):
+    def healthy(self):
+        # the headless browser behind pyChatGPT may have crashed
+        try:
+            self.bot.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        self.bot.driver.quit()
+
+    def chat(self, prompt, conversation=None):
+        # ChatGPT keeps the context itself, the conversation is only recorded
         logger.info("start chat")
         response = self.bot.send_message(prompt)
         logger.info(f"response: {response}")
+        if conversation is not None:
+            conversation.add(conversation.user, prompt)
+            conversation.add(conversation.assistant, response["message"])
         return response["message"]
 
+    async def achat(self, prompt, conversation=None):
+        return await asyncio.to_thread(self.chat, prompt, conversation)
+
+    def chat_stream(self, prompt, conversation=None):
+        # pyChatGPT does not stream, the whole response is a single delta
+        yield self.chat(prompt, conversation)
+
 
 class RevPyChatGPTBot:
+    # the conversation context lives upstream, answers depend on it
+    stateful = True
+
     def __init__(self, config="config.json"):
+        from revChatGPT.Official import Chatbot
+
         if isinstance(config, str):
             config = json.load(open(config))
         self.bot = Chatbot(api_key=config["api_key"])
 
-    def chat(self, prompt):
+    def chat(self, prompt, conversation=None):
+        # revChatGPT keeps its own history, the conversation is only recorded
         logger.info("start chat")
         response = self.bot.ask(prompt)
         logger.info(f"response: {response}")
-        return response["choices"][0]["text"]
+        text = response["choices"][0]["text"]
+        if conversation is not None:
+            conversation.add(conversation.user, prompt)
+            conversation.add(conversation.assistant, text)
+        return text
+
+    async def achat(self, prompt, conversation=None):
+        return await asyncio.to_thread(self.chat, prompt, conversation)
+
+    def chat_stream(self, prompt, conversation=None):
+        # the official revChatGPT bot does not stream, the whole response is a single delta
+        yield self.chat(prompt, conversation)
@@ -0,0 +1,399 @@
+import json
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from jaivus.pool import ENGINES
+from jaivus.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+API_BASE = "https://api.openai.com/v1"
+RETRY_STATUS = [429, 500, 502, 503, 504]
+POOL_SIZE = 32
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+_buckets = {}
+_buckets_lock = threading.Lock()
+_hedge_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="hedge")
+_batch_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="batch")
+
+
+class OpenAIError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super(OpenAIError, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRY_STATUS
+
+
+def get_session(api_base):
+    # keep-alive connections per host, shared by all clients of the process,
+    # the api key is sent per request so sessions never mix credentials
+    return ENGINES.get("http_session", api_base, _new_session)
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _retry_after(headers):
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenAIClient:
+    """Completions client owning its api key and request policy.
+
+    Every call has a deadline of `timeout` seconds covering all attempts.
+    Connection errors, 429 and 5xx responses are retried with jittered
+    exponential backoff. With `hedge_after` set, a second identical request
+    is sent if the first has not answered after that many seconds and the
+    first response wins.
+    """
+
+    def __init__(
+        self,
+        api_key,
+        api_base=API_BASE,
+        timeout=60,
+        retries=3,
+        backoff=0.5,
+        hedge_after=None,
+    ):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self.requests = 0
+        self.retried = 0
+        self.hedged = 0
+
+    @property
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "retried": self.retried,
+            "hedged": self.hedged,
+        }
+
+    @property
+    def headers(self):
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json",
+        }
+
+    def _delay(self, attempt, error, deadline):
+        delay = random.uniform(0, self.backoff * 2**attempt)
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        if time.time() + delay >= deadline:
+            return None
+        return delay
+
+    def _attempts(self, deadline):
+        # yields the attempt number, the caller breaks out on success
+        for attempt in range(self.retries + 1):
+            if time.time() >= deadline:
+                break
+            self.requests += 1
+            yield attempt
+
+    def _check(self, status, text, headers):
+        if status >= 400:
+            raise OpenAIError(
+                f"completion request failed with status {status}: {text[:200]}",
+                status,
+                _retry_after(headers),
+            )
+
+    def _post(self, path, payload, timeout, stream=False):
+        try:
+            response = get_session(self.api_base).post(
+                f"{self.api_base}{path}",
+                headers=self.headers,
+                json=payload,
+                timeout=timeout,
+                stream=stream,
+            )
+        except requests.RequestException as e:
+            raise OpenAIError(f"completion request failed: {e}")
+        if response.status_code >= 400:
+            self._check(response.status_code, response.text, response.headers)
+        return response
+
+    def _request(self, path, payload, deadline, stream=False):
+        error = None
+        for attempt in self._attempts(deadline):
+            if attempt:
+                self.retried += 1
+                TRACER.count("completion_retries")
+            try:
+                with TRACER.span("completion_request", stream=stream):
+                    return self._post(path, payload, deadline - time.time(), stream)
+            except OpenAIError as e:
+                error = e
+                if not e.retryable:
+                    raise
+                delay = self._delay(attempt, e, deadline)
+                if delay is None:
+                    break
+                logger.warning(f"{e} -> retry in {round(delay, 3)} seconds")
+                time.sleep(delay)
+        raise error or OpenAIError("completion request deadline exceeded")
+
+    def complete(self, **params):
+        deadline = time.time() + self.timeout
+        if self.hedge_after is None:
+            return self._request("/completions", params, deadline).json()
+        first = _hedge_executor.submit(self._request, "/completions", params, deadline)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result().json()
+        self.hedged += 1
+        TRACER.count("completion_hedges")
+        logger.info(f"no response after {self.hedge_after} seconds, hedging request")
+        second = _hedge_executor.submit(self._request, "/completions", params, deadline)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None or not pending:
+                    # the straggler finishes in the background and is ignored
+                    return future.result().json()
+
+    def stream_complete(self, **params):
+        # yields the completion chunks, only the connection is retried
+        deadline = time.time() + self.timeout
+        response = self._request(
+            "/completions", dict(params, stream=True), deadline, stream=True
+        )
+        with response:
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[len(b"data: ") :]
+                if data == b"[DONE]":
+                    return
+                yield json.loads(data)
+
+
+def get_dispatcher(client, **kwargs):
+    # one dispatcher per account and settings, the quota is shared per account
+    key = (
+        client.api_base,
+        client.api_key,
+        client.timeout,
+        client.retries,
+        client.backoff,
+        client.hedge_after,
+        tuple(sorted(kwargs.items())),
+    )
+    # held by the bots for their lifetime, so not evicted like engines
+    with _dispatchers_lock:
+        if key not in _dispatchers:
+            _dispatchers[key] = BatchDispatcher(client, **kwargs)
+        return _dispatchers[key]
+
+
+def get_token_bucket(client, kind, per_minute):
+    # requests and tokens per minute are limited per account, not per dispatcher,
+    # the buckets are the account's quota and are never evicted like engines
+    if not per_minute:
+        return None
+    key = (client.api_base, client.api_key, kind, per_minute)
+    with _buckets_lock:
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(per_minute / 60)
+        return _buckets[key]
+
+
+class TokenBucket:
+    """Rate limiter refilling `rate` tokens per second up to `capacity`.
+
+    The capacity defaults to one second of tokens, at least one. Requests
+    are charged their full cost, one larger than the bucket drives it
+    negative and the next caller waits until it is paid off.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.waited = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        # blocks until the tokens are paid for
+        with self._lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= tokens
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            self.waited += delay
+            time.sleep(delay)
+
+
+class BatchDispatcher:
+    """Sends concurrent completion requests as multi prompt requests.
+
+    Requests with identical sampling parameters are collected for up to
+    `max_wait` seconds or until `max_batch` prompts are queued, then sent as
+    one request whose choices are routed back to the callers. Optional token
+    buckets limit requests per minute and estimated tokens per minute, for
+    batches and streamed requests alike.
+    """
+
+    def __init__(
+        self,
+        client,
+        max_batch=16,
+        max_wait=0.01,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+    ):
+        self.client = client
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.request_limiter = get_token_bucket(client, "requests", requests_per_minute)
+        self.token_limiter = get_token_bucket(client, "tokens", tokens_per_minute)
+        self.batches = 0
+        self.prompts = 0
+        self.closed = False
+        self._queues = {}
+        self._ready = threading.Condition()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="dispatcher"
+        )
+        self._thread.start()
+
+    @property
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "prompts": self.prompts,
+            "mean_batch_size": (
+                round(self.prompts / self.batches, 2) if self.batches else 0
+            ),
+        }
+
+    def submit(self, prompt, **params):
+        # returns a future of the response with the choices of this prompt
+        future = Future()
+        key = json.dumps(params, sort_keys=True)
+        with self._ready:
+            assert not self.closed
+            queue = self._queues.setdefault(key, [])
+            queue.append((time.time(), prompt, future))
+            self._ready.notify()
+        return future
+
+    def complete(self, prompt, **params):
+        return self.submit(prompt, **params).result()
+
+    def stream(self, prompt, **params):
+        # streamed requests are not batched but count against the quota
+        self._acquire([prompt], params)
+        return self.client.stream_complete(prompt=prompt, **params)
+
+    def close(self):
+        # stops the dispatcher thread, queued requests fail
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+        self._thread.join()
+
+    def _acquire(self, prompts, params):
+        if self.request_limiter is not None:
+            self.request_limiter.acquire()
+        if self.token_limiter is not None:
+            # about four characters per token plus the completion budget
+            self.token_limiter.acquire(
+                sum(len(str(p)) // 4 + params.get("max_tokens", 16) for p in prompts)
+            )
+
+    def _next_batch(self):
+        # waits for the oldest queue to be full or old enough, None once closed
+        with self._ready:
+            while True:
+                if self.closed:
+                    for queue in self._queues.values():
+                        for _, _, future in queue:
+                            future.set_exception(OpenAIError("dispatcher closed"))
+                    self._queues.clear()
+                    return None
+                now = time.time()
+                due = None
+                for key, queue in self._queues.items():
+                    ready_at = queue[0][0] + self.max_wait
+                    if len(queue) >= self.max_batch or ready_at <= now:
+                        batch = queue[: self.max_batch]
+                        del queue[: self.max_batch]
+                        if not queue:
+                            del self._queues[key]
+                        return json.loads(key), batch
+                    due = ready_at if due is None else min(due, ready_at)
+                self._ready.wait(None if due is None else due - now)
+
+    def _run(self):
+        while True:
+            item = self._next_batch()
+            if item is None:
+                return
+            params, batch = item
+            try:
+                self._acquire([prompt for _, prompt, _ in batch], params)
+                self.batches += 1
+                self.prompts += len(batch)
+                _batch_executor.submit(self._send, params, batch)
+            except Exception as e:
+                # the dispatcher thread must survive, the callers get the error
+                logger.warning(f"dispatching batch failed with: {e}")
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _send(self, params, batch):
+        prompts = [prompt for _, prompt, _ in batch]
+        error = None
+        try:
+            response = self.client.complete(prompt=prompts, **params)
+            logger.info(f"sent batch of {len(prompts)} prompts")
+            n = params.get("n", 1)
+            choices = [[] for _ in batch]
+            for choice in response["choices"]:
+                choices[choice["index"] // n].append(choice)
+            for (_, _, future), prompt_choices in zip(batch, choices):
+                future.set_result(dict(response, choices=prompt_choices))
+        except Exception as e:
+            error = e
+        finally:
+            # every caller gets an answer, also for malformed responses
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(
+                        error or OpenAIError("completion response has no choice")
+                    )
@@ -1,46 +1,615 @@
 import logging
-import queue
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import numpy as np
-import pydub
 import speech_recognition as sr
-from streamlit_webrtc import WebRtcMode, webrtc_streamer
 
-import jaivus.patch
+from jaivus.audio import (
+    AudioBuffer,
+    downmix,
+    frame_to_ndarray,
+    mfcc,
+    preprocess,
+    read_wav,
+    resample,
+    resample_poly,
+    subsequence_dtw,
+)
+from jaivus.pool import ENGINES
+from jaivus.receiver import FrameRing
+from jaivus.registry import Registry
+from jaivus.trace import TRACER
 
 logger = logging.getLogger(__name__)
 
 QUEUE_SIZE = 1024
-SUPPORTED_LISTENER = ["web", "local"]
-SUPPORTED_RECOGNIZER = [
-    "google",
-    "whisper",
-    "google_cloud",
-    "sphinx",
-    "wit",
-    "azure",
-    "bing",
-    "lex",
-    "houndify",
-    "amazon",
-    "ibm",
-    "tensorflow",
-    "assemblyai",
-    "vosk",
-]
+# milliseconds of microphone audio queued for a listener that falls behind
+MICROPHONE_BUFFER = 10000
+# seconds without a read after which the microphone audio only adapts the vad
+MICROPHONE_IDLE_TIMEOUT = 5
+RECOGNITION_WORKERS = 4
+WAKE_WORD_HANGOVER = 400
+# while the assistant speaks, the user must be this much louder than the speech
+# threshold and speak for this many milliseconds to interrupt it
+ECHO_RATIO = 3.0
+BARGE_IN_MIN_SPEECH = 250
+# backends are imported when selected, packages add more with "jaivus.listeners" entry points
+LISTENERS = Registry(
+    "jaivus.listeners",
+    {"web": "jaivus.listen:WebListener", "local": "jaivus.listen:LocalListener"},
+)
+SUPPORTED_LISTENER = list(LISTENERS.backends)
+# preprocessing of utterances per recognizer, see jaivus.audio.preprocess
+SPEECH_PREPROCESSING = {"target_rate": 16000, "highpass_cutoff": 80}
+LOCAL_PREPROCESSING = {"target_rate": 16000}
+SUPPORTED_RECOGNIZER = {
+    "google": SPEECH_PREPROCESSING,
+    "whisper": LOCAL_PREPROCESSING,
+    "google_cloud": SPEECH_PREPROCESSING,
+    "sphinx": LOCAL_PREPROCESSING,
+    "wit": SPEECH_PREPROCESSING,
+    "azure": SPEECH_PREPROCESSING,
+    "bing": SPEECH_PREPROCESSING,
+    "lex": SPEECH_PREPROCESSING,
+    "houndify": SPEECH_PREPROCESSING,
+    "amazon": SPEECH_PREPROCESSING,
+    "ibm": SPEECH_PREPROCESSING,
+    "tensorflow": LOCAL_PREPROCESSING,
+    "assemblyai": SPEECH_PREPROCESSING,
+    "vosk": LOCAL_PREPROCESSING,
+}
+SUPPORTED_WAKE_WORD_DETECTOR = [None, "template", "sphinx"]
+SUPPORTED_WHISPER_BACKEND = [None, "faster_whisper", "whisper"]
+WHISPER_ENGINE_OPTIONS = ["model", "backend", "compute_type", "cpu_threads"]
+RACE_OPTIONS = ["confidence", "timeout"]
+WHISPER_SAMPLE_RATE = 16000
+
+_whisper_engines = {}
+_whisper_engines_lock = threading.Lock()
 
 
 def get_listener(listener, recognizer, **kwargs):
-    assert listener in SUPPORTED_LISTENER
-    if listener == "local":
-        return LocalListener(recognizer, **kwargs)
-    elif listener == "web":
-        return WebListener(recognizer, **kwargs)
+    assert listener in LISTENERS
+    return LISTENERS.load(listener)(recognizer, **kwargs)
+
+
+def get_wake_word_detector(detector, wake_word, **kwargs):
+    # returns None, i.e. escalate to the recognizer, if the detector is unavailable
+    assert detector in SUPPORTED_WAKE_WORD_DETECTOR
+    try:
+        if detector == "template":
+            if not kwargs.get("templates"):
+                # a detector without templates would never fire
+                logger.warning(
+                    f"no templates to spot the wake word {wake_word},"
+                    f" matching the recognizer's transcripts instead"
+                )
+                return None
+            return TemplateWakeWordDetector(wake_word, **kwargs)
+        if detector == "sphinx":
+            return SphinxWakeWordDetector(wake_word, **kwargs)
+    except ImportError as e:
+        logger.warning(f"{detector} wake word detector unavailable: {e}")
+    return None
+
+
+def get_recognition_executor():
+    # one pool per process, shared by the listeners of all sessions
+    return ENGINES.get(
+        "recognition_executor",
+        RECOGNITION_WORKERS,
+        lambda: ThreadPoolExecutor(
+            max_workers=RECOGNITION_WORKERS, thread_name_prefix="recognizer"
+        ),
+    )
+
+
+def get_whisper_engine(model="base", backend=None, compute_type="int8", cpu_threads=0):
+    # one model per config and process, shared by the listeners of all sessions,
+    # loaded once and never evicted while listeners may hold it
+    key = (model, backend, compute_type, cpu_threads)
+    with _whisper_engines_lock:
+        if key not in _whisper_engines:
+            _whisper_engines[key] = WhisperEngine(*key)
+        return _whisper_engines[key]
+
+
+class WhisperEngine:
+    """Local Whisper speech recognition, the model is loaded once.
+
+    faster-whisper is used when installed, its CTranslate2 models run with
+    int8 weights on CPU by default, otherwise the openai-whisper model runs
+    in float32. Decodes are serialized per engine, `cpu_threads` bounds the
+    threads of a single decode (0 uses the library default).
+    """
+
+    def __init__(self, model="base", backend=None, compute_type="int8", cpu_threads=0):
+        assert backend in SUPPORTED_WHISPER_BACKEND
+        if backend is None:
+            try:
+                import faster_whisper  # noqa: F401
+
+                backend = "faster_whisper"
+            except ImportError:
+                backend = "whisper"
+        self.backend = backend
+        self.model_name = model
+        self.compute_type = compute_type
+        self.cpu_threads = cpu_threads
+        self.decodes = 0
+        self.decode_time = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+        logger.info(f"loading {backend} {model} model")
+        t = time.time()
+        if backend == "faster_whisper":
+            from faster_whisper import WhisperModel
+
+            self.model = WhisperModel(
+                model, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads
+            )
+        else:
+            import torch
+            import whisper
+
+            if compute_type != "float32":
+                logger.warning(
+                    f"{compute_type} weights need faster-whisper, using float32"
+                )
+            if cpu_threads:
+                torch.set_num_threads(cpu_threads)
+            self.model = whisper.load_model(model, device="cpu")
+        logger.info(f"loaded {model} model in {round(time.time() - t, 3)} seconds")
+
+    @property
+    def stats(self):
+        return {
+            "decodes": self.decodes,
+            "decode_time": round(self.decode_time, 3),
+            "skipped": self.skipped,
+        }
+
+    def transcribe(self, samples, sample_rate, blocking=True, **options):
+        # returns the text of mono samples, None if not blocking and the engine is busy
+        audio = resample_poly(samples, sample_rate, WHISPER_SAMPLE_RATE)
+        audio = audio.astype(np.float32) / 32768
+        if not self._lock.acquire(blocking=blocking):
+            self.skipped += 1
+            return None
+        try:
+            t = time.time()
+            if self.backend == "faster_whisper":
+                options.setdefault("beam_size", 1)
+                segments, _ = self.model.transcribe(audio, **options)
+                text = "".join(segment.text for segment in segments)
+            else:
+                text = self.model.transcribe(audio, fp16=False, **options)["text"]
+            self.decodes += 1
+            self.decode_time += time.time() - t
+        finally:
+            self._lock.release()
+        return text.strip()
+
+    def recognize(self, audio, **options):
+        # same contract as the speech_recognition recognizers
+        samples = np.frombuffer(audio.get_raw_data(convert_width=2), dtype=np.int16)
+        text = self.transcribe(samples, audio.sample_rate, **options)
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+class RecognizerRace:
+    """Runs several recognizers on an utterance concurrently.
+
+    The first transcript with a confidence of at least `confidence` wins,
+    recognizers not reporting a confidence always qualify. Stragglers are
+    ignored and time out after `timeout` seconds, then the most confident
+    transcript so far is returned. Recognizers run on the shared recognition
+    executor. Latency, failures and wins are counted per recognizer.
+    """
+
+    def __init__(self, recognizers, confidence=0.6, timeout=10):
+        # recognizers is a list of names or a dict of names to keyword arguments
+        if not isinstance(recognizers, dict):
+            recognizers = {name: {} for name in recognizers}
+        self.confidence = confidence
+        self.timeout = timeout
+        self.recognizer = sr.Recognizer()
+        self.recognizer.operation_timeout = timeout
+        self.engines = {}
+        for name, kwargs in recognizers.items():
+            assert name in SUPPORTED_RECOGNIZER
+            self.engines[name] = self._engine(name, dict(kwargs))
+        self.races = 0
+        self._stats = {
+            name: {"started": 0, "failed": 0, "timeouts": 0, "wins": 0, "latency": []}
+            for name in self.engines
+        }
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        stats = {}
+        with self._lock:
+            for name, engine in self._stats.items():
+                latency = engine["latency"]
+                stats[name] = {
+                    "started": engine["started"],
+                    "failed": engine["failed"],
+                    "timeouts": engine["timeouts"],
+                    "wins": engine["wins"],
+                    "win_rate": (
+                        round(engine["wins"] / self.races, 3) if self.races else 0
+                    ),
+                    "mean_latency": (
+                        round(float(np.mean(latency)), 3) if latency else None
+                    ),
+                    "p95_latency": (
+                        round(float(np.percentile(latency, 95)), 3) if latency else None
+                    ),
+                }
+        return stats
+
+    def _engine(self, name, kwargs):
+        # returns a function of the audio returning the text and its confidence
+        if name == "whisper":
+            engine = get_whisper_engine(
+                **{k: kwargs.pop(k) for k in WHISPER_ENGINE_OPTIONS if k in kwargs}
+            )
+            return lambda audio: (engine.recognize(audio, **kwargs), None)
+        if name == "google":
+            return lambda audio: self._recognize_google(audio, **kwargs)
+        function = getattr(self.recognizer, f"recognize_{name}")
+        return lambda audio: (function(audio, **kwargs), None)
+
+    def _recognize_google(self, audio, **kwargs):
+        result = self.recognizer.recognize_google(audio, show_all=True, **kwargs)
+        if not result or not result.get("alternative"):
+            raise sr.UnknownValueError()
+        best = result["alternative"][0]
+        return best["transcript"], best.get("confidence")
+
+    def _run(self, name, audio):
+        with self._lock:
+            self._stats[name]["started"] += 1
+        t = time.time()
+        try:
+            return self.engines[name](audio)
+        except Exception:
+            with self._lock:
+                self._stats[name]["failed"] += 1
+            raise
+        finally:
+            TRACER.record(f"recognize_{name}", time.time() - t)
+            with self._lock:
+                # the last 1000 latencies per recognizer
+                latency = self._stats[name]["latency"]
+                latency.append(time.time() - t)
+                del latency[:-1000]
+
+    def _win(self, name):
+        with self._lock:
+            self._stats[name]["wins"] += 1
+
+    def recognize(self, audio):
+        # same contract as the speech_recognition recognizers
+        deadline = time.time() + self.timeout
+        with self._lock:
+            self.races += 1
+        # the recognizers of all listeners share the recognition threads
+        executor = get_recognition_executor()
+        futures = {
+            executor.submit(self._run, name, audio): name for name in self.engines
+        }
+        pending = set(futures)
+        best = None
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=max(0, deadline - time.time()),
+                return_when=FIRST_COMPLETED,
+            )
+            if not done:
+                break
+            for future in done:
+                name = futures[future]
+                try:
+                    text, confidence = future.result()
+                except Exception as e:
+                    logger.info(f"{name} recognizer failed with: {e!r}")
+                    continue
+                logger.info(f"{name} recognized: {text} (confidence: {confidence})")
+                if confidence is None or confidence >= self.confidence:
+                    for straggler in pending:
+                        straggler.cancel()
+                    self._win(name)
+                    return text
+                if best is None or confidence > best[0]:
+                    best = (confidence, text, name)
+        for future in pending:
+            future.cancel()
+            with self._lock:
+                self._stats[futures[future]]["timeouts"] += 1
+        if best is None:
+            raise sr.UnknownValueError()
+        self._win(best[2])
+        return best[1]
+
+
+class VoiceActivityDetector:
+    """Frame level speech detector based on energy and zero crossing rate.
+
+    The energy threshold follows the ambient noise level of non-speech frames.
+    A pluggable model, any callable taking mono samples and the sample rate and
+    returning a speech probability or bool, replaces the heuristic when given.
+    """
+
+    def __init__(
+        self,
+        energy_threshold=300,
+        energy_ratio=3.0,
+        zero_crossing_rate=0.35,
+        noise_adaptation=0.05,
+        model=None,
+    ):
+        self.energy_threshold = energy_threshold
+        self.energy_ratio = energy_ratio
+        self.zero_crossing_rate = zero_crossing_rate
+        self.noise_adaptation = noise_adaptation
+        self.noise_level = None
+        self.model = model
+        # raised while the assistant speaks, its echo must not count as speech
+        self.echo_ratio = 1.0
+
+    @property
+    def threshold(self):
+        if self.noise_level is None:
+            return self.energy_threshold
+        return max(self.energy_threshold, self.noise_level * self.energy_ratio)
+
+    def is_speech(self, samples, sample_rate):
+        mono = downmix(samples)
+        if len(mono) == 0:
+            return False
+        if self.model is not None:
+            speech = self.model(mono, sample_rate) >= 0.5
+            if self.echo_ratio == 1 or not speech:
+                return speech
+            return rms(mono) > self.threshold * self.echo_ratio
+        energy = rms(mono)
+        crossings = np.count_nonzero(np.signbit(mono[1:]) != np.signbit(mono[:-1]))
+        speech = (
+            energy > self.threshold and crossings / len(mono) < self.zero_crossing_rate
+        )
+        if energy <= self.threshold:
+            # loud non-speech like sibilants or clicks must not raise the floor
+            self.update_noise_level(energy)
+        # speech below the echo threshold is taken for the assistant's voice
+        return speech and energy > self.threshold * self.echo_ratio
+
+    def adapt(self, samples, sample_rate):
+        # follows the ambient noise with audio that is not segmented, e.g. between
+        # listen calls, louder frames are taken for speech and skipped
+        mono = downmix(samples)
+        if len(mono) == 0 or self.model is not None:
+            return
+        energy = rms(mono)
+        if energy <= self.threshold:
+            self.update_noise_level(energy)
+
+    def update_noise_level(self, energy):
+        if self.noise_level is None:
+            self.noise_level = energy
+        else:
+            self.noise_level += self.noise_adaptation * (energy - self.noise_level)
+
+
+def rms(mono):
+    mono = mono.astype(np.float32)
+    return np.sqrt(np.mean(mono * mono))
+
+
+class WebRtcVadModel:
+    """Adapter for the optional webrtcvad package as VoiceActivityDetector model."""
+
+    def __init__(self, aggressiveness=2):
+        import webrtcvad
+
+        self.vad = webrtcvad.Vad(aggressiveness)
+
+    def __call__(self, samples, sample_rate):
+        # webrtcvad accepts 10, 20 or 30 ms int16 frames only
+        return self.vad.is_speech(samples.astype(np.int16).tobytes(), sample_rate)
+
+
+class Endpointer:
+    """Cuts a stream of audio frames into utterances.
+
+    Leading silence is dropped except for a short pre-roll, an utterance is
+    emitted once the speaker has been silent for `hangover` milliseconds or
+    after `max_utterance` milliseconds of audio.
+    """
+
+    def __init__(
+        self,
+        vad=None,
+        hangover=800,
+        max_utterance=15000,
+        min_speech=100,
+        pre_roll=300,
+    ):
+        self.vad = vad if vad is not None else VoiceActivityDetector()
+        self.hangover = hangover
+        self.max_utterance = max_utterance
+        self.min_speech = min_speech
+        self.pre_roll = pre_roll
+        self.buffer = None
+        self.reset()
+
+    @property
+    def sample_rate(self):
+        return self.buffer.sample_rate
+
+    @property
+    def sample_width(self):
+        return self.buffer.sample_width
+
+    def reset(self, max_utterance=None, hangover=None):
+        if max_utterance is not None:
+            self.max_utterance = max_utterance
+        if hangover is not None:
+            self.hangover = hangover
+        self.triggered = False
+        self._speech_duration = 0
+        self._silence_duration = 0
+        self._pre_roll_frames = []
+        self._pre_roll_duration = 0
+        if self.buffer is not None:
+            self.buffer.clear()
+
+    def _start_utterance(self, samples, sample_rate):
+        capacity = int(self.max_utterance / 1000 * sample_rate)
+        if (
+            self.buffer is None
+            or self.buffer.capacity != capacity
+            or self.buffer.sample_rate != sample_rate
+            or self.buffer.channels != samples.shape[1]
+            or self.buffer.dtype != samples.dtype
+        ):
+            self.buffer = AudioBuffer(
+                self.max_utterance,
+                sample_rate,
+                channels=samples.shape[1],
+                dtype=samples.dtype,
+            )
+        self.buffer.clear()
+        for frame, _ in self._pre_roll_frames:
+            self.buffer.write(frame)
+        self._pre_roll_frames = []
+        self._pre_roll_duration = 0
+        self._silence_duration = 0
+        self.triggered = True
+        logger.info("speech detected")
+
+    def peek(self, duration=None):
+        # the last `duration` ms of the current utterance as mono samples
+        if not self.triggered:
+            return None
+        samples = self.buffer.read()
+        if duration is not None:
+            samples = samples[-int(duration / 1000 * self.sample_rate) :]
+        return samples
+
+    def process(self, samples, sample_rate):
+        # returns the utterance as mono samples once it is complete, else None
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        duration = len(samples) / sample_rate * 1000
+        speech = self.vad.is_speech(samples, sample_rate)
+
+        if not self.triggered:
+            self._pre_roll_frames.append((samples, duration))
+            self._pre_roll_duration += duration
+            while (
+                self._pre_roll_duration - self._pre_roll_frames[0][1] >= self.pre_roll
+            ):
+                self._pre_roll_duration -= self._pre_roll_frames.pop(0)[1]
+            self._speech_duration = self._speech_duration + duration if speech else 0
+            if self._speech_duration >= self.min_speech:
+                self._start_utterance(samples, sample_rate)
+            return None
+
+        self.buffer.write(samples)
+        self._silence_duration = 0 if speech else self._silence_duration + duration
+        if self._silence_duration >= self.hangover or self.buffer.full:
+            logger.info(
+                f"end of speech after {round(self.buffer.duration)} ms"
+                f" ({round(self._silence_duration)} ms silence)"
+            )
+            utterance = self.buffer.read()
+            self.reset()
+            return utterance
+        return None
+
+
+class TemplateWakeWordDetector:
+    """Spots the wake word by matching MFCC features against recorded templates.
+
+    Templates are 16 bit wav recordings of the wake word, ideally made with the
+    same microphone, more can be added at runtime with `enroll`. An utterance
+    matches if the length normalized DTW cost against any template span is
+    below `threshold`. Without templates nothing matches, so
+    `get_wake_word_detector` returns None and the recognizer spots the wake
+    word instead.
+    """
+
+    def __init__(self, wake_word, templates=(), threshold=5.0, sample_rate=16000):
+        self.wake_word = wake_word
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.templates = []
+        for template in templates:
+            self.templates.append(self.features(*read_wav(template)))
+
+    def features(self, samples, sample_rate):
+        samples = resample(samples, sample_rate, self.sample_rate)
+        # c0 is dropped to make matching independent of the loudness
+        return mfcc(samples, self.sample_rate)[:, 1:]
+
+    def audio_features(self, audio):
+        samples = np.frombuffer(audio.get_raw_data(convert_width=2), dtype=np.int16)
+        return self.features(samples, audio.sample_rate)
+
+    def enroll(self, audio):
+        self.templates.append(self.audio_features(audio))
+
+    def detect(self, audio):
+        features = self.audio_features(audio)
+        for template in self.templates:
+            cost = subsequence_dtw(template, features)
+            logger.info(f"wake word template cost: {round(cost, 3)}")
+            if cost < self.threshold:
+                return True
+        return False
+
+
+class SphinxWakeWordDetector:
+    """Spots the wake word with the offline pocketsphinx keyword search.
+
+    `sensitivity` ranges from 0 to 1, speech_recognition maps it to the
+    pocketsphinx keyword threshold, higher values spot more and false alarm
+    more.
+    """
+
+    def __init__(self, wake_word, sensitivity=0.8):
+        assert 0 <= sensitivity <= 1
+        import pocketsphinx  # noqa: F401
+
+        self.wake_word = wake_word
+        self.sensitivity = sensitivity
+        self.recognizer = sr.Recognizer()
+
+    def detect(self, audio):
+        try:
+            text = self.recognizer.recognize_sphinx(
+                audio, keyword_entries=[(self.wake_word.lower(), self.sensitivity)]
+            )
+        except sr.UnknownValueError:
+            return False
+        return self.wake_word.lower() in text.lower()
 
 
 class Streamer:
     def __init__(self):
+        from streamlit_webrtc import WebRtcMode, webrtc_streamer
+
+        # the receiver must be patched before the streamer creates it
+        import jaivus.patch  # noqa: F401
+
         logger.info(f"initializing webrtc streamer")
         self.streamer = webrtc_streamer(
             key="speech-to-text",
@@ -56,105 +625,299 @@ class Streamer:
     def playing(self):
         return self.streamer.state.playing
 
+    @property
+    def frames(self):
+        return self.streamer.audio_receiver._frames_queue
+
+    @property
+    def stats(self):
+        return self.frames.stats
+
     def empty(self):
-        self.streamer.audio_receiver._frames_queue = queue.Queue(QUEUE_SIZE)
+        self.frames.clear()
+
+    def get_frames(self, timeout=1):
+        # returns every queued frame as soon as at least one is available
+        return self.frames.drain(timeout=timeout)
+
 
-    def get_frames(self):
+class MicrophoneStream:
+    """Keeps one microphone stream open, captured on a background thread.
+
+    Chunks are queued in a bounded FrameRing while a listener reads the
+    stream, so audio from the start of a listen call on is never lost and
+    no stream is opened per utterance. After `idle_timeout` seconds without
+    a read, chunks go to `on_idle`, e.g. to follow the ambient noise, and are
+    dropped. Has the Streamer interface.
+    """
+
+    def __init__(
+        self,
+        device_index=None,
+        chunk_size=1024,
+        buffer=MICROPHONE_BUFFER,
+        idle_timeout=MICROPHONE_IDLE_TIMEOUT,
+        on_idle=None,
+    ):
+        self.microphone = sr.Microphone(
+            device_index=device_index, chunk_size=chunk_size
+        )
+        self.sample_rate = self.microphone.SAMPLE_RATE
+        self.frames = FrameRing(
+            max(1, int(buffer / 1000 * self.sample_rate / chunk_size))
+        )
+        self.idle_timeout = idle_timeout
+        self.on_idle = on_idle
+        self.last_read = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._capture, daemon=True, name="microphone"
+        )
+        self._thread.start()
+
+    @property
+    def playing(self):
+        return self._thread.is_alive()
+
+    @property
+    def idle(self):
+        return time.time() - self.last_read > self.idle_timeout
+
+    @property
+    def stats(self):
+        return self.frames.stats
+
+    def _capture(self):
         try:
-            return self.streamer.audio_receiver.get_frames(timeout=1)
-        except queue.Empty:
-            time.sleep(0.1)
-            return []
+            with self.microphone as source:
+                logger.info(f"microphone stream opened at {self.sample_rate} Hz")
+                while not self._stop.is_set():
+                    data = source.stream.read(source.CHUNK)
+                    samples = np.frombuffer(data, dtype=np.int16)
+                    if not self.idle:
+                        self.frames.put(samples)
+                    elif self.on_idle is not None:
+                        self.on_idle(samples, self.sample_rate)
+        except Exception as e:
+            logger.warning(f"microphone stream failed with: {e}")
+        logger.info("microphone stream closed")
+
+    def empty(self):
+        self.last_read = time.time()
+        self.frames.clear()
+
+    def get_frames(self, timeout=1):
+        self.last_read = time.time()
+        return self.frames.drain(timeout=timeout)
+
+    def close(self):
+        self._stop.set()
 
 
 class LocalListener:
-    def __init__(self, recognizer="google", duration=2, **kwargs):
-        assert recognizer in SUPPORTED_RECOGNIZER
-        logger.info(f"initializing {recognizer} speech recognition engine")
+    def __init__(
+        self,
+        recognizer="google",
+        streamer=None,
+        hangover=800,
+        max_utterance=15000,
+        vad=None,
+        on_partial=None,
+        partial_interval=1000,
+        partial_window=10000,
+        preprocessing=None,
+        **kwargs,
+    ):
+        # a list or dict of recognizers races them, see RecognizerRace
+        names = [recognizer] if isinstance(recognizer, str) else list(recognizer)
+        assert names and all(name in SUPPORTED_RECOGNIZER for name in names)
+        logger.info(f"initializing {', '.join(names)} speech recognition engine")
         self.recognizer = sr.Recognizer()
-        self.recognizer_function_name = f"recognize_{recognizer}"
+        self.recognizer_function_name = f"recognize_{names[0]}"
+        self.whisper = None
+        self.race = None
+        if not isinstance(recognizer, str):
+            self.race = RecognizerRace(
+                recognizer, **{k: kwargs.pop(k) for k in RACE_OPTIONS if k in kwargs}
+            )
+        elif recognizer == "whisper":
+            # the remaining kwargs are decoding options, e.g. language
+            self.whisper = get_whisper_engine(
+                **{k: kwargs.pop(k) for k in WHISPER_ENGINE_OPTIONS if k in kwargs}
+            )
         self.kwargs = kwargs
-        self.start_time = time.time()
-        self.duration = duration
-        if duration is not None:
-            with sr.Microphone() as source:
+        self.preprocessing = dict(
+            SUPPORTED_RECOGNIZER[names[0]], **(preprocessing or {})
+        )
+        # partial transcripts of the ongoing utterance, whisper only
+        self.on_partial = on_partial
+        self.partial_interval = partial_interval
+        self.partial_window = partial_window
+        self._partial = None
+        self._partial_at = 0
+        if vad is None:
+            vad = VoiceActivityDetector(self.recognizer.energy_threshold)
+        self.hangover = hangover
+        self.max_utterance = max_utterance
+        self.endpointer = Endpointer(vad, hangover, max_utterance)
+        self.min_speech = self.endpointer.min_speech
+        # the vad follows the ambient noise while nobody listens, instead of
+        # a calibration at startup
+        if streamer is None:
+            streamer = MicrophoneStream(on_idle=self.endpointer.vad.adapt)
+        self.streamer = streamer
+
+    @property
+    def is_active(self):
+        return self.streamer.playing
+
+    def healthy(self):
+        return self.is_active
+
+    def close(self):
+        # releases the microphone, e.g. when the engine pool rebuilds the listener
+        close = getattr(self.streamer, "close", None)
+        if close is not None:
+            close()
+
+    def frame_samples(self, frame):
+        # the microphone stream queues int16 chunks
+        return frame, self.streamer.sample_rate
+
+    def process(self, samples, sample_rate):
+        # runs the endpointer, decodes partial transcripts every `partial_interval` ms
+        utterance = self.endpointer.process(samples, sample_rate)
+        if self.whisper is None or self.on_partial is None:
+            return utterance
+        if utterance is not None:
+            # the final transcript supersedes a pending partial one
+            self._partial = None
+            self._partial_at = 0
+            return utterance
+        if self._partial is not None and self._partial.done():
+            text = self._partial.result()
+            self._partial = None
+            if text:
+                self.on_partial(text)
+        if not self.endpointer.triggered:
+            self._partial_at = 0
+        elif (
+            self._partial is None
+            and self.endpointer.buffer.duration - self._partial_at
+            >= self.partial_interval
+        ):
+            self._partial_at = self.endpointer.buffer.duration
+            self._partial = get_recognition_executor().submit(
+                self.transcribe_partial,
+                self.endpointer.peek(self.partial_window),
+                self.endpointer.sample_rate,
+            )
+        return utterance
+
+    def transcribe_partial(self, samples, sample_rate):
+        # skipped while the engine decodes, final transcripts take priority
+        try:
+            return self.whisper.transcribe(
+                samples, sample_rate, blocking=False, **self.kwargs
+            )
+        except Exception as e:
+            logger.warning(f"partial transcription failed with: {e}")
+
+    def audio_data(self, samples, sample_rate):
+        # resamples and filters an utterance as configured for the recognizer
+        samples, sample_rate = preprocess(samples, sample_rate, **self.preprocessing)
+        return sr.AudioData(samples.tobytes(), sample_rate, samples.dtype.itemsize)
+
+    def poll(self, timeout=1):
+        # feeds the queued frames to the endpointer, returns completed utterances
+        utterances = []
+        for audio_frame in self.streamer.get_frames(timeout):
+            utterance = self.process(*self.frame_samples(audio_frame))
+            if utterance is not None:
+                audio = self.audio_data(utterance, self.endpointer.sample_rate)
                 logger.info(
-                    f"wait {duration} seconds to adjust the recognizer to ambient noise"
+                    f"captured {len(utterance)} samples, sending {len(audio.frame_data)} bytes"
+                    f" with rate:{audio.sample_rate} width:{audio.sample_width}"
                 )
-                self.recognizer.adjust_for_ambient_noise(source, duration=duration)
+                utterances.append(audio)
+        return utterances
+
+    def start_listening(self, number_of_chunks=None):
+        # drops the audio heard so far, e.g. the assistant's own voice
+        self.streamer.empty()
+        self.endpointer.reset(
+            max_utterance=number_of_chunks or self.max_utterance,
+            hangover=self.hangover,
+        )
+
+    def start_barge_in(self, echo_ratio=ECHO_RATIO, min_speech=BARGE_IN_MIN_SPEECH):
+        # listens while the assistant speaks, see hearing_speech
+        self.start_listening()
+        self.endpointer.vad.echo_ratio = echo_ratio
+        self.endpointer.min_speech = min_speech
+
+    def stop_barge_in(self):
+        # the rest of the utterance is segmented with the usual thresholds
+        self.endpointer.vad.echo_ratio = 1.0
+        self.endpointer.min_speech = self.min_speech
 
     @property
-    def is_active(self):
-        if time.time() - self.start_time > self.duration:
-            return True
-        return False
+    def hearing_speech(self):
+        return self.endpointer.triggered
+
+    def start_wake_word(self, number_of_chunks=2000):
+        # keeps the endpointer state, consecutive calls must not clip utterances
+        self.endpointer.max_utterance = number_of_chunks
+        self.endpointer.hangover = WAKE_WORD_HANGOVER
 
-    def listen(self, **kwargs):
-        with sr.Microphone() as source:
-            logger.info("start listening")
-            audio = self.recognizer.listen(source)
-        logger.info("stop listening")
-        return self.recognize(audio)
+    def spot_wake_word(self, audio, wake_word, detector=None, verify=False):
+        # the local detector screens utterances, only hits reach the recognizer
+        if detector is not None:
+            t = time.time()
+            detected = detector.detect(audio)
+            logger.info(
+                f"wake word detected: {detected} (timing: {round(time.time() - t, 3)} seconds)"
+            )
+            if not detected or not verify:
+                return detected
+        text = self.recognize(audio)
+        return text is not None and wake_word.lower() in text.lower()
 
     def recognize(self, audio):
         try:
             logger.info("start recognizing")
             t = time.time()
-            text = getattr(self.recognizer, self.recognizer_function_name)(
-                audio, **self.kwargs
-            )
+            if self.race is not None:
+                text = self.race.recognize(audio)
+            elif self.whisper is not None:
+                text = self.whisper.recognize(audio, **self.kwargs)
+            else:
+                text = getattr(self.recognizer, self.recognizer_function_name)(
+                    audio, **self.kwargs
+                )
             time_parsing = time.time() - t
+            TRACER.record("recognize", time_parsing)
             logger.info(
                 f"recognized: {text} (timing: {round(time_parsing, 3)} seconds)"
             )
             logger.info(f"stop recognizing")
             return text
         except sr.UnknownValueError as e:
+            TRACER.count("recognition_unknown")
             logger.warning(f"recognizer could not understand audio")
         except sr.RequestError as e:
+            TRACER.count("recognition_errors")
             logger.warning(f"could not request results from recognizer")
 
 
 class WebListener(LocalListener):
-    def __init__(self, recognizer="google", **kwargs):
-        super(WebListener, self).__init__(recognizer, duration=None, **kwargs)
-        self.streamer = Streamer()
-
-    @property
-    def is_active(self):
-        return self.streamer.playing
-
-    def recognize_frames(self, audio_frames, sample_rate, sample_width):
-        audio = sr.AudioData(audio_frames, sample_rate, sample_width)
-        return self.recognize(audio)
-
-    def listen(self, number_of_chunks=10000):
-        logger.info("start listening")
-        self.streamer.empty()
-        sound_chunk = pydub.AudioSegment.empty()
-        while True:
-            audio_frames = self.streamer.get_frames()
-
-            for audio_frame in audio_frames:
-                sound = pydub.AudioSegment(
-                    data=audio_frame.to_ndarray().tobytes(),
-                    sample_width=audio_frame.format.bytes,
-                    frame_rate=audio_frame.sample_rate,
-                    channels=len(audio_frame.layout.channels),
-                )
-                sound_chunk += sound
+    def __init__(self, recognizer="google", streamer=None, **kwargs):
+        # any object with the Streamer interface, e.g. to replay recorded audio
+        super(WebListener, self).__init__(
+            recognizer,
+            streamer=streamer if streamer is not None else Streamer(),
+            **kwargs,
+        )
 
-            if len(sound_chunk) > number_of_chunks:
-                sample_width = audio_frames[0].format.bytes
-                sample_rate = audio_frames[0].sample_rate
-                sound_chunk = sound_chunk.set_channels(1).set_frame_rate(sample_rate)
-                buffer = np.array(sound_chunk.get_array_of_samples())
-                logger.info(
-                    f"trying to recognize {len(sound_chunk)} chunks with rate:{sample_width} width:{sample_rate}"
-                )
-                text = self.recognize_frames(buffer, sample_rate, sample_width)
-                sound_chunk = pydub.AudioSegment.empty()
-                self.streamer.empty()
-                if text is not None:
-                    logger.info("stop listening")
-                    return text
+    def frame_samples(self, audio_frame):
+        return frame_to_ndarray(audio_frame), audio_frame.sample_rate
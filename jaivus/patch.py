@@ -1,11 +1,17 @@
 import logging
-import queue
 
 from streamlit_webrtc.receive import MediaReceiver
 
+from jaivus.receiver import FrameRing
+
 logger = logging.getLogger(__name__)
 
-QUEUE_SIZE = 1024
+_media_receiver_init = MediaReceiver.__init__
+
+
+def _init_patch(self, *args, **kwargs):
+    _media_receiver_init(self, *args, **kwargs)
+    self._frames_queue = FrameRing(self._frames_queue.maxsize)
 
 
 async def _run_track_patch(self, track):
@@ -14,12 +20,10 @@ async def _run_track_patch(self, track):
             frame = await track.recv()
         except Exception:
             return
-        if self._frames_queue.full():
-            if self._frame_read:
-                logger.warning("Queue overflow. Emptying queue.")
-            self._frames_queue = queue.Queue(QUEUE_SIZE)
+        # the ring drops the oldest frame on overflow and counts the loss
         self._frames_queue.put(frame)
 
 
-# we patch the asyn _run_trac method to empty the queue if it overflows
+# we patch the receiver to queue frames in a bounded ring with loss accounting
+MediaReceiver.__init__ = _init_patch
 MediaReceiver._run_track = _run_track_patch
@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+
+from jaivus.cache import cache_key
+
+logger = logging.getLogger(__name__)
+
+IDLE_TIMEOUT = 1800
+
+
+class EnginePool:
+    """Process wide registry of engines, shared across reruns and sessions.
+
+    Engines are built lazily by their factory on first use and reused for
+    the same kind and config. Engines not requested for `idle_timeout`
+    seconds are dropped from the pool and closed if they define `close()`,
+    so devices they hold, e.g. the microphone, are released before a new
+    engine opens them again. Running conversations `touch` their engines to
+    keep them. Engines defining `healthy()` are rebuilt, and closed, once it
+    returns False. The pool's state is guarded by one lock, a per key lock
+    only serializes the builds of an engine.
+    """
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.built = 0
+        self.reused = 0
+        self.evicted = 0
+        self._engines = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._engines)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                "engines": len(self._engines),
+                "built": self.built,
+                "reused": self.reused,
+                "evicted": self.evicted,
+            }
+
+    def get(self, kind, config, factory):
+        self.evict_idle()
+        key = (kind, cache_key(config))
+        engine = self._reuse(key)
+        if engine is not None:
+            return engine
+        with self._lock:
+            # engines of different keys are built concurrently, one per key
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # a concurrent call may have built it meanwhile
+            engine = self._reuse(key)
+            if engine is None:
+                logger.info(f"building {kind} engine")
+                engine = factory()
+                with self._lock:
+                    self._engines[key] = (engine, time.time())
+                    self.built += 1
+        with self._lock:
+            if self._locks.get(key) is key_lock:
+                del self._locks[key]
+        return engine
+
+    def _reuse(self, key):
+        # the pooled engine of the key if it is healthy, None otherwise
+        with self._lock:
+            entry = self._engines.get(key)
+        if entry is None:
+            return None
+        engine = entry[0]
+        if not self._healthy(engine):
+            logger.warning(f"{key[0]} engine failed its health check, rebuilding")
+            self._discard(key, engine)
+            return None
+        with self._lock:
+            entry = self._engines.get(key)
+            if entry is None or entry[0] is not engine:
+                # removed while its health was checked
+                return None
+            self._engines[key] = (engine, time.time())
+            self.reused += 1
+        return engine
+
+    def _discard(self, key, engine):
+        # removes and closes the engine, unless it was replaced meanwhile
+        with self._lock:
+            entry = self._engines.get(key)
+            if entry is None or entry[0] is not engine:
+                return
+            del self._engines[key]
+            self._locks.pop(key, None)
+            self.evicted += 1
+        self._close(engine)
+
+    def _healthy(self, engine):
+        healthy = getattr(engine, "healthy", None)
+        try:
+            return healthy is None or healthy()
+        except Exception as e:
+            logger.warning(f"engine health check failed with: {e}")
+            return False
+
+    def _close(self, engine):
+        close = getattr(engine, "close", None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                logger.warning(f"closing engine failed with: {e}")
+
+    def touch(self, kind, config):
+        # marks an engine as used, e.g. by a conversation running without reruns
+        key = (kind, cache_key(config))
+        with self._lock:
+            entry = self._engines.get(key)
+            if entry is not None:
+                self._engines[key] = (entry[0], time.time())
+
+    def remove(self, kind, config):
+        key = (kind, cache_key(config))
+        with self._lock:
+            entry = self._engines.get(key)
+        if entry is not None:
+            self._discard(key, entry[0])
+
+    def evict_idle(self):
+        now = time.time()
+        with self._lock:
+            idle = [
+                key
+                for key, (_, last_used) in self._engines.items()
+                if now - last_used > self.idle_timeout
+            ]
+            engines = []
+            for key in idle:
+                logger.info(f"evicting idle {key[0]} engine")
+                engines.append(self._engines.pop(key)[0])
+                self._locks.pop(key, None)
+                self.evicted += 1
+        # closed outside the lock, e.g. releasing a microphone takes a while
+        for engine in engines:
+            self._close(engine)
+
+
+ENGINES = EnginePool()
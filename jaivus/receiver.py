@@ -0,0 +1,91 @@
+import logging
+import queue
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class FrameRing:
+    """Fixed capacity frame queue that drops the oldest frame on overflow.
+
+    Implements the subset of queue.Queue used by streamlit_webrtc's
+    MediaReceiver and keeps counters of received, dropped, drained and
+    discarded frames.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._frames = deque(maxlen=maxsize)
+        self._ready = threading.Condition()
+        self._overflowing = False
+        self.received = 0
+        self.dropped = 0
+        self.drained = 0
+        self.discarded = 0
+
+    def qsize(self):
+        return len(self._frames)
+
+    def empty(self):
+        return not self._frames
+
+    def full(self):
+        return len(self._frames) == self.maxsize
+
+    @property
+    def stats(self):
+        return {
+            "received": self.received,
+            "dropped": self.dropped,
+            "drained": self.drained,
+            "discarded": self.discarded,
+            "queued": self.qsize(),
+            "loss_rate": self.dropped / self.received if self.received else 0.0,
+        }
+
+    def put(self, frame, block=True, timeout=None):
+        with self._ready:
+            if self.full():
+                # the deque drops the oldest frame itself on append
+                self.dropped += 1
+                if not self._overflowing:
+                    logger.warning(
+                        f"frame queue overflow, dropping oldest frames (dropped {self.dropped} of {self.received})"
+                    )
+                    self._overflowing = True
+            self._frames.append(frame)
+            self.received += 1
+            self._ready.notify_all()
+
+    def put_nowait(self, frame):
+        self.put(frame, block=False)
+
+    def get(self, block=True, timeout=None):
+        frames = self.drain(1, timeout if block else 0)
+        if not frames:
+            raise queue.Empty
+        return frames[0]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def drain(self, max_frames=None, timeout=None):
+        # waits up to timeout seconds for frames and returns all available ones
+        with self._ready:
+            if timeout != 0:
+                self._ready.wait_for(lambda: self._frames, timeout)
+            count = len(self._frames)
+            if max_frames is not None:
+                count = min(count, max_frames)
+            frames = [self._frames.popleft() for _ in range(count)]
+            self.drained += count
+            if count:
+                self._overflowing = False
+            return frames
+
+    def clear(self):
+        with self._ready:
+            self.discarded += len(self._frames)
+            self._frames.clear()
+            self._overflowing = False
@@ -0,0 +1,75 @@
+import importlib
+import logging
+import threading
+from importlib.metadata import entry_points
+
+logger = logging.getLogger(__name__)
+
+
+class Registry:
+    """Backends of one kind by name, imported only when selected.
+
+    Built-in backends are "module:attribute" paths, so importing the registry
+    imports none of them nor their third party packages. Other packages add
+    backends with entry points of the registry's group, e.g. in their
+    pyproject.toml:
+
+        [project.entry-points."jaivus.chatbots"]
+        mybot = "mypackage.chat:MyBot"
+    """
+
+    def __init__(self, group, backends):
+        self.group = group
+        self.backends = dict(backends)
+        self._loaded = {}
+        self._entry_points = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, name):
+        return name in self.backends or name in self.entry_points
+
+    @property
+    def entry_points(self):
+        # discovered on first use, scanning the installed distributions is slow
+        if self._entry_points is None:
+            try:
+                found = entry_points(group=self.group)
+            except Exception as e:
+                logger.warning(f"discovering {self.group} entry points failed: {e}")
+                found = []
+            self._entry_points = {ep.name: ep for ep in found}
+        return self._entry_points
+
+    @property
+    def names(self):
+        return list(self.backends) + [
+            name for name in self.entry_points if name not in self.backends
+        ]
+
+    def register(self, name, backend):
+        # a backend object or its "module:attribute" path
+        with self._lock:
+            self.backends[name] = backend
+            self._loaded.pop(name, None)
+
+    def load(self, name):
+        with self._lock:
+            if name not in self._loaded:
+                self._loaded[name] = self._import(name)
+            return self._loaded[name]
+
+    def _import(self, name):
+        backend = self.backends.get(name)
+        if backend is None:
+            if name not in self.entry_points:
+                raise KeyError(f"unknown {self.group} backend: {name}")
+            logger.info(f"loading {self.group} backend {name} from entry point")
+            return self.entry_points[name].load()
+        if not isinstance(backend, str):
+            return backend
+        logger.info(f"loading {self.group} backend {name} from {backend}")
+        module, _, attribute = backend.partition(":")
+        backend = importlib.import_module(module)
+        for part in attribute.split(".") if attribute else []:
+            backend = getattr(backend, part)
+        return backend
@@ -0,0 +1,644 @@
+import asyncio
+import functools
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from jaivus.speak import SentenceSplitter, audio_duration, split_sentences
+from jaivus.trace import TRACER
+
+logger = logging.getLogger(__name__)
+
+# concurrent calls per engine type across all sessions of the process
+ENGINE_LIMITS = {"listen": 16, "recognize": 4, "chat": 8, "speak": 4}
+SESSION_TIMEOUT = 300
+# utterances of a session recognized at once while it keeps capturing
+RECOGNITION_IN_FLIGHT = 2
+POLL_TIMEOUT = 0.1
+SPEECH_RATE = 120
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime(**kwargs):
+    # one runtime per process, shared by all sessions
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = Runtime(**kwargs)
+        return _runtime
+
+
+class FairLimiter:
+    """Limits the concurrent calls of an engine type.
+
+    Waiting calls are granted slots round robin by session, so a session
+    queueing many calls, e.g. the sentences of a long answer, does not starve
+    the others. Used from the event loop thread only.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.calls = 0
+        self.wait_time = 0
+        self._waiting = OrderedDict()
+
+    @property
+    def waiting(self):
+        return sum(len(futures) for futures in self._waiting.values())
+
+    @property
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "wait_time": round(self.wait_time, 3),
+        }
+
+    async def acquire(self, session_id):
+        self.calls += 1
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(session_id, deque()).append(future)
+        t = time.time()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was handed over before the cancellation
+                self.release()
+            raise
+        finally:
+            self.wait_time += time.time() - t
+
+    def release(self):
+        # hands the slot over to the next waiting session
+        while self._waiting:
+            session_id, futures = next(iter(self._waiting.items()))
+            future = futures.popleft()
+            if futures:
+                self._waiting.move_to_end(session_id)
+            else:
+                del self._waiting[session_id]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class RecognitionStage:
+    """Recognizes the utterances of a session while it keeps capturing.
+
+    Completed utterances are recognized in the background while the session
+    polls the next ones, so speech during a slow recognition is not lost. At
+    most `max_in_flight` utterances are in flight, further ones wait for a
+    slot while the receiver queues the frames (backpressure). Results are
+    returned in submission order, results of utterances captured before the
+    session stopped listening are returned by its next listen. Used from the
+    event loop thread only.
+    """
+
+    def __init__(self, session, max_in_flight=RECOGNITION_IN_FLIGHT):
+        self.session = session
+        self.max_in_flight = max_in_flight
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.backpressure_waits = 0
+        self.backpressure_time = 0
+        self.recognition_time = 0
+        self.peak_in_flight = 0
+        self._pending = deque()
+
+    @property
+    def pending(self):
+        # utterances whose result was not returned yet
+        return len(self._pending)
+
+    @property
+    def in_flight(self):
+        return sum(not task.done() for task in self._pending)
+
+    @property
+    def stats(self):
+        return {
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "pending": self.pending,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "backpressure_waits": self.backpressure_waits,
+            "backpressure_time": round(self.backpressure_time, 3),
+            "recognition_time": round(self.recognition_time, 3),
+        }
+
+    async def submit(self, audio):
+        if self.in_flight >= self.max_in_flight:
+            self.backpressure_waits += 1
+            logger.warning(
+                f"{self.max_in_flight} utterances in flight, waiting for the recognizer"
+            )
+            t = time.time()
+            await asyncio.wait(
+                [task for task in self._pending if not task.done()],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            self.backpressure_time += time.time() - t
+        self._pending.append(asyncio.ensure_future(self._recognize(audio)))
+        self.submitted += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    async def _recognize(self, audio):
+        t = time.time()
+        try:
+            return await self.session.call(
+                "recognize", self.session.listener.recognize, audio
+            )
+        except Exception as e:
+            logger.warning(f"recognition failed with: {e}")
+            self.failed += 1
+        finally:
+            self.recognition_time += time.time() - t
+            self.completed += 1
+
+    def results(self):
+        # yields the results of finished utterances, keeping submission order
+        while self._pending and self._pending[0].done():
+            task = self._pending.popleft()
+            if not task.cancelled():
+                yield task.result()
+
+    def cancel(self):
+        for task in self._pending:
+            task.cancel()
+        self._pending.clear()
+
+
+class Runtime:
+    """Runs the conversations of all sessions on one event loop.
+
+    Blocking engine calls run on a thread pool per engine type, bounded by
+    `limits`, so threads and concurrent STT, LLM and TTS calls no longer
+    grow with the number of sessions. Sessions not read by their view for
+    `session_timeout` seconds are stopped.
+    """
+
+    def __init__(self, limits=None, session_timeout=SESSION_TIMEOUT):
+        self.limits = dict(ENGINE_LIMITS, **(limits or {}))
+        self.session_timeout = session_timeout
+        self.sessions = {}
+        self.executors = {
+            kind: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=kind)
+            for kind, limit in self.limits.items()
+        }
+        self.limiters = {
+            kind: FairLimiter(limit) for kind, limit in self.limits.items()
+        }
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self._run, daemon=True, name="runtime").start()
+        asyncio.run_coroutine_threadsafe(self._reap(), self.loop)
+
+    @property
+    def stats(self):
+        stats = {"sessions": len(self.sessions)}
+        for kind, limiter in self.limiters.items():
+            stats[kind] = limiter.stats
+        # the recognition stages of the running sessions
+        recognition = {}
+        for session in list(self.sessions.values()):
+            for name, value in session.recognition.stats.items():
+                if name == "peak_in_flight":
+                    recognition[name] = max(recognition.get(name, 0), value)
+                else:
+                    recognition[name] = recognition.get(name, 0) + value
+        stats["recognition"] = recognition
+        return stats
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def call(self, kind, session_id, function, *args):
+        # runs a blocking engine call on the pool of its engine type
+        limiter = self.limiters[kind]
+        await limiter.acquire(session_id)
+        try:
+            return await self.loop.run_in_executor(
+                self.executors[kind], functools.partial(function, *args)
+            )
+        finally:
+            limiter.release()
+
+    def start_session(self, session_id, **kwargs):
+        self.stop_session(session_id)
+        session = ConversationSession(self, session_id, **kwargs)
+        self.sessions[session_id] = session
+        session.task = asyncio.run_coroutine_threadsafe(session.run(), self.loop)
+        logger.info(f"started session {session_id}")
+        return session
+
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is not None and not session.running:
+            return None
+        return session
+
+    def stop_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            session.stop()
+            logger.info(f"stopped session {session_id}")
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.session_timeout / 10)
+            now = time.time()
+            for session_id, session in list(self.sessions.items()):
+                if (
+                    now - session.last_read > self.session_timeout
+                    or not session.running
+                ):
+                    logger.info(f"session {session_id} is not read anymore")
+                    self.stop_session(session_id)
+
+
+class BargeIn(Exception):
+    """The user started speaking while the assistant answered."""
+
+    def __init__(self, utterances):
+        super(BargeIn, self).__init__("the user interrupted the answer")
+        self.utterances = utterances
+
+
+class ConversationSession:
+    """The listen, chat and speak state machine of one conversation.
+
+    Runs on the runtime's event loop and reports to its view through events,
+    tuples of a kind and a value: ("state", name), ("status", text),
+    ("user", text), ("delta", text), ("assistant", text),
+    ("audio", (text, data)), ("interrupt", None), ("turn", trace) and
+    ("error", message). Audio is synthesized by the session and played by the
+    view, the session waits for the playback before it listens again.
+    Listeners provide the polling interface of LocalListener.
+
+    With `barge_in`, the session keeps listening while it answers. Once the
+    user speaks, the completion, the synthesis and the playback are cancelled
+    and the interrupting utterance is recognized right away.
+
+    With `traced`, the turns of the session are traced even if the process
+    tracer is disabled.
+    """
+
+    def __init__(
+        self,
+        runtime,
+        session_id,
+        listener,
+        chatbot,
+        speaker,
+        conversation=None,
+        transcript=None,
+        wake_word=None,
+        detector=None,
+        prompts=None,
+        assistant="Jarvis",
+        barge_in=False,
+        traced=False,
+    ):
+        self.runtime = runtime
+        self.id = session_id
+        self.listener = listener
+        self.chatbot = chatbot
+        self.speaker = speaker
+        self.conversation = conversation
+        self.transcript = transcript
+        self.wake_word = wake_word
+        self.detector = detector
+        self.prompts = prompts or {}
+        self.assistant = assistant
+        self.barge_in = barge_in
+        self.traced = traced
+        self.state = "starting"
+        self.task = None
+        self.events = queue.Queue()
+        self.last_read = time.time()
+        self.playing_until = 0
+        # sentences handed to the view in the current turn
+        self.spoken = []
+        # the completion of the current turn ended, the bot recorded the answer
+        self.answered = False
+        # utterances heard while the assistant was interrupted
+        self.pending = None
+        # trace record of the current turn, None without tracing
+        self.record = None
+        self.recognition = RecognitionStage(self)
+
+    @property
+    def running(self):
+        return self.task is None or not self.task.done()
+
+    def emit(self, kind, value=None):
+        self.events.put((kind, value))
+
+    def set_state(self, state, status=None):
+        self.state = state
+        self.emit("state", state)
+        if status is not None:
+            self.emit("status", status)
+
+    def next_event(self, timeout=None):
+        # the next event for the view, None after the timeout
+        self.last_read = time.time()
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def call(self, kind, function, *args):
+        # spans of the engine call are recorded in the current turn
+        if self.record is None:
+            return self.runtime.call(kind, self.id, function, *args)
+        return self.runtime.call(
+            kind, self.id, TRACER.run_in_turn, self.record, function, *args
+        )
+
+    async def run(self):
+        try:
+            if self.wake_word is not None:
+                self.set_state(
+                    "waking",
+                    f'{self.prompts.get("wake_word", "")} **"{self.wake_word}"**',
+                )
+                await self.say(self.prompts.get("wake_word"))
+                await self.wait_for_wake_word()
+                self.set_state("speaking", self.prompts.get("wake_word_detected"))
+                await self.say(self.prompts.get("wake_word_detected"))
+            else:
+                self.set_state("speaking", self.prompts.get("start"))
+                await self.say(self.prompts.get("start"))
+            while True:
+                await self.turn()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"session {self.id} failed with: {e}")
+            self.emit("error", str(e))
+        finally:
+            self.recognition.cancel()
+            self.set_state("stopped")
+
+    async def turn(self):
+        self.set_state("listening", "I am listening to you")
+        self.record = TRACER.new_turn(self.id, self.traced)
+        t = time.time()
+        text = await self.listen()
+        start = time.time()
+        spans = {"listen": start - t}
+        if text is None:
+            self.emit("status", "Sorry, I didn't understand this")
+            return
+        self.set_state("thinking", f'I am processing your command: "*{text}*"')
+        self.emit("user", text)
+        if self.transcript is not None:
+            self.transcript.append("You", text, listen_time=spans["listen"])
+
+        self.spoken = []
+        self.answered = False
+        response = None
+        watcher = None
+        stop = asyncio.Event()
+        if self.barge_in and hasattr(self.listener, "start_barge_in"):
+            watcher = asyncio.ensure_future(self.watch_barge_in(stop))
+        try:
+            response, first_token = await self.interruptible(
+                watcher, self.respond(text)
+            )
+            spans["response"] = time.time() - start
+            if first_token is not None:
+                spans["first_token"] = first_token
+            self.emit("assistant", response)
+            if self.transcript is not None:
+                self.transcript.append(
+                    self.assistant,
+                    response,
+                    first_token_time=first_token,
+                    chat_time=spans["response"],
+                )
+            self.trace(t, spans)
+            await self.interruptible(watcher, self.wait_playback())
+        except BargeIn as e:
+            self.interrupt(e.utterances, response is None, t, spans)
+        finally:
+            if watcher is not None:
+                stop.set()
+                await asyncio.gather(watcher, return_exceptions=True)
+
+    async def interruptible(self, watcher, coroutine):
+        # runs the coroutine until it ends or the user barges in
+        if watcher is None:
+            return await coroutine
+        task = asyncio.ensure_future(coroutine)
+        try:
+            await asyncio.wait([task, watcher], return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.done() or watcher.exception() is not None:
+            return await task
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise BargeIn(watcher.result())
+
+    async def watch_barge_in(self, stop):
+        # listens while the assistant answers, returns once the user speaks
+        self.listener.start_barge_in()
+        try:
+            while not stop.is_set():
+                utterances = await self.call("listen", self.listener.poll, POLL_TIMEOUT)
+                if utterances or self.listener.hearing_speech:
+                    return utterances
+        finally:
+            self.listener.stop_barge_in()
+
+    def interrupt(self, utterances, answering, start, spans):
+        logger.info(f"session {self.id} interrupted by the user")
+        TRACER.run_in_turn(self.record, TRACER.count, "barge_ins")
+        self.emit("interrupt")
+        self.playing_until = 0
+        self.pending = utterances
+        if not answering:
+            return
+        # only the sentences handed to the view may have been heard
+        heard = " ".join(self.spoken)
+        if self.conversation is not None and not getattr(
+            self.chatbot, "stateful", False
+        ):
+            if self.answered:
+                # the bot recorded the whole answer, the heard part replaces it
+                self.conversation.amend(self.conversation.assistant, heard)
+            elif heard:
+                self.conversation.add(self.conversation.assistant, heard)
+        if heard and self.transcript is not None:
+            self.transcript.append(self.assistant, heard, interrupted=True)
+        spans["barge_in"] = time.time() - start - spans["listen"]
+        self.trace(start, spans)
+
+    async def listen(self):
+        # after a barge in, the interrupting utterance is already under way
+        utterances, self.pending = self.pending, None
+        if utterances is None:
+            self.listener.start_listening()
+        while True:
+            # utterances recognized meanwhile, also from before this call
+            for text in self.recognition.results():
+                if text is not None:
+                    return text
+            for audio in utterances or []:
+                await self.recognition.submit(audio)
+            utterances = await self.call("listen", self.listener.poll, POLL_TIMEOUT)
+
+    async def wait_for_wake_word(self):
+        self.listener.start_wake_word()
+        while True:
+            for audio in await self.call("listen", self.listener.poll, POLL_TIMEOUT):
+                if await self.call(
+                    "recognize",
+                    self.listener.spot_wake_word,
+                    audio,
+                    self.wake_word,
+                    self.detector,
+                ):
+                    return
+
+    async def respond(self, text):
+        # streams the completion, sentences are synthesized while it streams
+        loop = asyncio.get_running_loop()
+        deltas = asyncio.Queue()
+        clips = asyncio.Queue()
+        done = object()
+        cancelled = threading.Event()
+        synthesizing = []
+
+        def stream():
+            # closing the stream closes the connection, the generation stops
+            response = self.chatbot.chat_stream(text, self.conversation)
+            try:
+                for delta in response:
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(deltas.put_nowait, delta)
+            finally:
+                response.close()
+                loop.call_soon_threadsafe(deltas.put_nowait, done)
+
+        def synthesize(sentence):
+            clip = self.synthesize(sentence)
+            if clip is not None:
+                synthesizing.append(clip)
+            clips.put_nowait((sentence, clip))
+
+        t = time.time()
+        chat = asyncio.ensure_future(self.call("chat", stream))
+        player = asyncio.ensure_future(self.play(clips))
+        response = ""
+        first_token = None
+        sentences = SentenceSplitter()
+        try:
+            while True:
+                delta = await deltas.get()
+                if delta is done:
+                    break
+                if first_token is None:
+                    first_token = time.time() - t
+                response += delta
+                self.emit("delta", delta)
+                for sentence in sentences.feed(delta):
+                    synthesize(sentence)
+            await chat
+            self.answered = True
+            for sentence in sentences.flush():
+                synthesize(sentence)
+        except BaseException:
+            cancelled.set()
+            chat.cancel()
+            player.cancel()
+            for clip in synthesizing:
+                clip.cancel()
+            raise
+        finally:
+            clips.put_nowait(None)
+        await player
+        return response, first_token
+
+    def synthesize(self, text):
+        if not hasattr(self.speaker, "synthesize_cached"):
+            return None
+        task = asyncio.ensure_future(
+            self.call("speak", self.speaker.synthesize_cached, text)
+        )
+        # clips dropped by a cancelled turn must not log unretrieved errors
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return task
+
+    async def play(self, clips):
+        # hands the clips to the view in order and tracks the playback time
+        while True:
+            item = await clips.get()
+            if item is None:
+                return
+            text, clip = item
+            if clip is None:
+                continue
+            try:
+                data = await clip
+            except Exception as e:
+                logger.warning(f"synthesis failed with: {e}")
+                await self.call("speak", self.speaker.fallback, text, e)
+                continue
+            self.emit("audio", (text, data))
+            self.spoken.append(text)
+            duration = audio_duration(data) or len(text.split()) / SPEECH_RATE * 60
+            self.playing_until = max(self.playing_until, time.time()) + duration
+
+    async def say(self, text):
+        if not text:
+            return
+        clips = asyncio.Queue()
+        for sentence in split_sentences(text):
+            clips.put_nowait((sentence, self.synthesize(sentence)))
+        clips.put_nowait(None)
+        await self.play(clips)
+        await self.wait_playback()
+
+    async def wait_playback(self):
+        # the assistant must not hear itself
+        delay = self.playing_until - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def trace(self, start, spans):
+        if self.record is None:
+            return
+        # recorded in the turn, the event loop thread runs in no turn
+        for name, duration in spans.items():
+            TRACER.run_in_turn(self.record, TRACER.record, name, duration)
+        duration = time.time() - start
+        TRACER.run_in_turn(self.record, TRACER.record, "turn", duration)
+        self.record["duration"] = round(duration, 6)
+        TRACER.finish(self.record)
+        self.emit("turn", self.record)
+        self.record = None
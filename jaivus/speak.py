@@ -1,57 +1,203 @@
+import abc
 import base64
+import copy
 import logging
-import os
+import re
 import time
-import uuid
+import wave
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
-import pyttsx3
-import streamlit as st
-from gtts import gTTS
+from jaivus.cache import DiskCache, LRUCache, TieredCache, cache_key
+from jaivus.registry import Registry
+from jaivus.synthesis import SYNTHESIS_WORKERS, get_synthesis_pool
+from jaivus.trace import TRACER
 
 logger = logging.getLogger(__name__)
 
-SUPPORTED_SPEAKER = [None, "gtts", "pyttsx3"]
+# backends are imported when selected, packages add more with "jaivus.speakers" entry points
+SPEAKERS = Registry(
+    "jaivus.speakers",
+    {"gtts": "jaivus.speak:GttsSpeaker", "pyttsx3": "jaivus.speak:Pyttsx3Speaker"},
+)
+SUPPORTED_SPEAKER = [None] + list(SPEAKERS.backends)
+# synthesized audio shared by all speakers of the process
+AUDIO_CACHE = LRUCache(max_entries=4096, max_bytes=64 * 2**20)
+# MPEG audio layer III bitrates (kbit/s) and sample rates (Hz) by version
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|(?<=[.!?][\"')\]])\s+|\n+")
+# a period after these ends no sentence, e.g. "Dr. Smith" or "J. Doe"
+ABBREVIATION = re.compile(
+    r"\b(?:Mr|Mrs|Ms|Dr|Prof|Sr|Jr|St|vs|approx|e\.g|i\.e|[A-Z])\.$", re.IGNORECASE
+)
+# the number of a list item, e.g. "3." in "3. Bananas", ends no sentence
+LIST_MARKER = re.compile(r"\d+\.")
+# characters, shorter fragments are spoken with the next sentence
+MIN_SENTENCE_LENGTH = 20
 
 
-def get_speaker(speaker, **kwargs):
-    assert speaker in SUPPORTED_SPEAKER
-    if speaker == "pyttsx3":
-        return Pyttsx3Speaker(**kwargs)
-    if speaker == "gtts":
-        return GttsSpeaker()
+def get_speaker(speaker, cache_dir=None, **kwargs):
     if speaker is None:
         return NoneSpeaker()
+    assert speaker in SPEAKERS
+    return SPEAKERS.load(speaker)(cache=get_audio_cache(cache_dir), **kwargs)
 
 
-def play_audio_bytes(data):
-    b64 = base64.b64encode(data).decode()
-    md = f"""
-        <audio autoplay="true">
-        <source src="data:audio/mp3;base64,{b64}" type="audio/mp3">
-        </audio>
-        """
-    st.markdown(
-        md,
-        unsafe_allow_html=True,
-    )
+def get_audio_cache(cache_dir=None, max_bytes=256 * 2**20):
+    # in-memory tier, optionally backed by an on-disk tier
+    if cache_dir is None:
+        return AUDIO_CACHE
+    return TieredCache(AUDIO_CACHE, DiskCache(cache_dir, max_bytes))
 
 
-def autoplay_audio(audio_file):
-    if isinstance(audio_file, BytesIO):
-        data = audio_file.getbuffer().tobytes()
-        return play_audio_bytes(data)
-    if isinstance(audio_file, str):
-        with open(audio_file, "rb") as f:
-            data = f.read()
-            return play_audio_bytes(data)
+def audio_data_uri(data, mimetype="audio/mp3"):
+    return f"data:{mimetype};base64,{base64.b64encode(data).decode()}"
+
+
+def audio_mimetype(data):
+    if data[:4] == b"RIFF":
+        return "audio/wav"
+    return "audio/mp3"
+
+
+def mp3_duration(data):
+    # sums the duration of the MPEG layer III frames, skipping an ID3v2 tag
+    position = 0
+    if data[:3] == b"ID3":
+        size = data[6] << 21 | data[7] << 14 | data[8] << 7 | data[9]
+        position = 10 + size
+    duration = 0
+    while position + 4 <= len(data):
+        header = int.from_bytes(data[position : position + 4], "big")
+        version = {3: 1, 2: 2, 0: 2.5}.get(header >> 19 & 3)
+        layer = header >> 17 & 3
+        bitrate_index = header >> 12 & 15
+        sample_rate_index = header >> 10 & 3
+        if (
+            header >> 21 != 0x7FF
+            or version is None
+            or layer != 1
+            or bitrate_index in (0, 15)
+            or sample_rate_index == 3
+        ):
+            position += 1
+            continue
+        bitrate = MP3_BITRATES[min(version, 2)][bitrate_index] * 1000
+        sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+        samples = 1152 if version == 1 else 576
+        padding = header >> 9 & 1
+        position += samples // 8 * bitrate // sample_rate + padding
+        duration += samples / sample_rate
+    return duration
+
+
+def audio_duration(data):
+    # duration of wav or mp3 audio in seconds
+    if data[:4] == b"RIFF":
+        with wave.open(BytesIO(data)) as audio:
+            return audio.getnframes() / audio.getframerate()
+    return mp3_duration(data)
+
+
+class AudioChannel:
+    """Plays audio clips in the browser through a single reused element.
+
+    Clips are registered with the Streamlit media file manager and fetched by
+    the browser as binary files instead of base64 inside the page. Each clip
+    replaces the previous one in the same element, so played clips are no
+    longer referenced and are released from the media file storage. Without
+    a Streamlit runtime the clip is inlined as a data URI.
+    """
+
+    def __init__(self):
+        import streamlit as st
+
+        self.placeholder = st.empty()
+        self.clips = 0
+        self.bytes = 0
+
+    @property
+    def stats(self):
+        return {"clips": self.clips, "bytes": self.bytes}
+
+    def url(self, data, mimetype):
+        try:
+            from streamlit import runtime
+
+            if runtime.exists():
+                manager = runtime.get_instance().media_file_mgr
+                coordinates = self.placeholder._get_delta_path_str()
+                url = manager.add(data, mimetype, coordinates)
+                manager.remove_orphaned_files()
+                return url
+        except Exception as e:
+            logger.warning(f"serving audio as media file failed with: {e}")
+        return audio_data_uri(data, mimetype)
+
+    def play(self, data, mimetype="audio/mp3"):
+        self.clips += 1
+        self.bytes += len(data)
+        # the clip number makes the element change even for a repeated clip
+        self.placeholder.markdown(
+            f'<audio autoplay="true" src="{self.url(data, mimetype)}#{self.clips}" '
+            f'type="{mimetype}"></audio>',
+            unsafe_allow_html=True,
+        )
+
+    def clear(self):
+        self.placeholder.empty()
+
+
+def split_sentences(text):
+    sentences = SentenceSplitter()
+    return sentences.feed(text) + sentences.flush()
+
+
+class SentenceSplitter:
+    """Collects streamed text deltas and returns the completed sentences."""
+
+    def __init__(self):
+        self.text = ""
+
+    def feed(self, delta):
+        self.text += delta
+        parts = SENTENCE_END.split(self.text)
+        # the last part is still incomplete
+        self.text = parts.pop()
+        sentences = []
+        sentence = ""
+        for part in parts:
+            sentence = f"{sentence} {part.strip()}".strip()
+            if (
+                len(sentence) >= MIN_SENTENCE_LENGTH
+                and not ABBREVIATION.search(sentence)
+                and not LIST_MARKER.fullmatch(part.strip())
+            ):
+                sentences.append(sentence)
+                sentence = ""
+        if sentence:
+            self.text = f"{sentence} {self.text}"
+        return sentences
+
+    def flush(self):
+        text, self.text = self.text.strip(), ""
+        return [text] if text else []
 
 
 def sleep_text(text, rate=120):
     words = len(text.split(" "))
     duration = words / rate * 60 + 1
     logger.info(f"sleeping {round(duration,3)} seconds while speaking {words} words")
-    time.sleep(duration)
+    with TRACER.span("sleep_text"):
+        time.sleep(duration)
 
 
 class NoneSpeaker:
@@ -59,60 +205,170 @@ class NoneSpeaker:
         logger.info(f"No speaker selected, running app muted")
         pass
 
-    def speak(self, text):
+    def speak(self, text, wait=True):
+        pass
+
+    def wait(self):
         pass
 
+    def stop(self):
+        pass
 
-class GttsSpeaker:
-    def __init__(self):
+    def warmup(self, phrases):
+        pass
+
+    def session(self):
+        return self
+
+
+class PipelinedSpeaker(abc.ABC):
+    """Speaks text sentence by sentence.
+
+    Sentences are synthesized on a worker pool, so sentence N+1 is rendered
+    while sentence N plays. Playback is tracked with the real duration of the
+    synthesized audio.
+    """
+
+    workers = 2
+    rate = 120
+
+    def __init__(self, cache=None):
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="synthesizer"
+        )
+        self.cache = cache
+        self.channel = None
+        self.playing_until = 0
+
+    @property
+    def voice(self):
+        # everything besides the text that changes the synthesized audio
+        return {}
+
+    def session(self):
+        # a view with its own playback state sharing engine, workers and cache,
+        # speakers from the engine pool are shared across sessions
+        speaker = copy.copy(self)
+        speaker.channel = AudioChannel()
+        speaker.playing_until = 0
+        return speaker
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    @abc.abstractmethod
+    def synthesize(self, text):
+        # returns the audio of the text
+        pass
+
+    def synthesize_cached(self, text):
+        if self.cache is None:
+            with TRACER.span("synthesize"):
+                return self.synthesize(text)
+        key = cache_key(type(self).__name__, self.voice, text)
+        data = self.cache.get(key)
+        if data is None:
+            with TRACER.span("synthesize"):
+                data = self.synthesize(text)
+            self.cache.set(key, data)
+        return data
+
+    def warmup(self, phrases):
+        # renders fixed phrases in the background so they play from the cache
+        for sentence in [s for phrase in phrases for s in split_sentences(phrase)]:
+            self.executor.submit(self.synthesize_cached, sentence)
+
+    def fallback(self, text, error):
+        pass
+
+    def play(self, text, data):
+        duration = audio_duration(data)
+        if not duration:
+            # unknown format, estimate the duration from the words
+            duration = len(text.split(" ")) / self.rate * 60
+        if self.channel is None:
+            self.channel = AudioChannel()
+        self.channel.play(data, audio_mimetype(data))
+        self.playing_until = time.time() + duration
+        logger.info(f"playing {round(duration, 3)} seconds of audio")
+
+    def stop(self):
+        # cuts the clip playing in the browser short
+        if self.channel is not None:
+            self.channel.clear()
+        self.playing_until = 0
+
+    def wait(self):
+        # blocks until the audio played so far has finished
+        duration = self.playing_until - time.time()
+        if duration > 0:
+            with TRACER.span("playback_wait"):
+                time.sleep(duration)
+
+    def speak(self, text, wait=True):
+        logger.info("start speaking")
+        sentences = split_sentences(text)
+        clips = [self.executor.submit(self.synthesize_cached, s) for s in sentences]
+        for sentence, clip in zip(sentences, clips):
+            try:
+                data = clip.result()
+            except Exception as e:
+                logger.warning(f"synthesis failed with: {e}")
+                self.wait()
+                self.fallback(sentence, e)
+                continue
+            self.wait()
+            self.play(sentence, data)
+        if wait:
+            self.wait()
+        logger.info("stop speaking")
+
+
+class GttsSpeaker(PipelinedSpeaker):
+    def __init__(self, lang="en", cache=None):
         logger.info(f"initializing gtts audio engine")
+        super(GttsSpeaker, self).__init__(cache)
+        self.lang = lang
 
-    def speak(self, text):
-        try:
-            logger.info("start speaking")
-            sound_file = BytesIO()
-            tts = gTTS(text, lang="en")
-            tts.write_to_fp(sound_file)
-            autoplay_audio(sound_file)
-            sleep_text(text)
-            logger.info("stop speaking")
-        except Exception as e:
-            logger.warning(f"gtts audio engine failed with: {e}")
+    @property
+    def voice(self):
+        return {"lang": self.lang}
 
+    def synthesize(self, text):
+        from gtts import gTTS
 
-class Pyttsx3Speaker:
-    def __init__(self, **kwargs):
+        sound_file = BytesIO()
+        tts = gTTS(text, lang=self.lang)
+        tts.write_to_fp(sound_file)
+        return sound_file.getvalue()
+
+
+class Pyttsx3Speaker(PipelinedSpeaker):
+    # sentences render in parallel on the shared pool of pyttsx3 processes
+    workers = SYNTHESIS_WORKERS
+    # words per minute of the pyttsx3 engines by default
+    rate = 200
+
+    def __init__(self, cache=None, **kwargs):
         logger.info(f"initializing pyttsx3 audio engine with properties {kwargs}")
+        super(Pyttsx3Speaker, self).__init__(cache)
         self.kwargs = kwargs
-        self._init_engine()
+        self.rate = kwargs.get("rate", self.rate)
 
-    def _init_engine(self):
-        self.engine = None
-        self.engine = pyttsx3.init()
-        for key, value in self.kwargs.items():
-            self.engine.setProperty(key, value)
-        self.rate = self.engine.getProperty("rate")
+    @property
+    def pool(self):
+        # looked up on use, the engine pool replaces a pool that is not healthy
+        return get_synthesis_pool()
 
-    def speak(self, text, save_to_file=True):
-        try:
-            logger.info("start speaking")
-            try:
-                audio_file = f"{uuid.uuid4()}.mp3"
-                logger.info(f"creating temp audio file: {audio_file}")
-                self.engine.save_to_file(text, audio_file)
-                self.engine.runAndWait()
-                autoplay_audio(audio_file)
-                sleep_text(text, self.rate)
-                os.remove(audio_file)
-            except FileNotFoundError as e:
-                logger.warning(f"{e} -> fall back to using default sound engine")
-                self.engine.say(text)
-                self.engine.runAndWait()
-                sleep_text(text, self.rate)
-            logger.info("stop speaking")
-        except RuntimeError as e:
-            logger.warning(f'pyttsx3 audio runtime error "{e}" -> restart audio engine')
-            self.engine.stop()
-            self.engine.endLoop()
-            self._init_engine()
-            self.speak(text, save_to_file)
+    @property
+    def voice(self):
+        return self.kwargs
+
+    def synthesize(self, text):
+        return self.pool.synthesize(text, **self.kwargs)
+
+    def fallback(self, text, error):
+        if isinstance(error, FileNotFoundError):
+            logger.warning(f"{error} -> fall back to using default sound engine")
+            self.pool.say(text, **self.kwargs)
+            sleep_text(text, self.rate)
@@ -0,0 +1,274 @@
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+from jaivus.pool import ENGINES
+
+logger = logging.getLogger(__name__)
+
+SYNTHESIS_WORKERS = min(4, os.cpu_count() or 1)
+SYNTHESIS_TIMEOUT = 30
+# seconds a caller waits for a job, the time it is queued included
+SYNTHESIS_WAIT_TIMEOUT = 120
+# memory backed, the audio written by the engine never reaches a disk
+SHARED_MEMORY_DIR = "/dev/shm"
+
+
+def get_synthesis_pool(**kwargs):
+    # one pool of pyttsx3 worker processes per process, shared by all speakers,
+    # rebuilt by the engine pool once it is not healthy anymore
+    return ENGINES.get("synthesis_pool", kwargs, lambda: SynthesisPool(**kwargs))
+
+
+def _init_engine(properties):
+    import pyttsx3
+
+    engine = pyttsx3.init()
+    for key, value in properties.items():
+        engine.setProperty(key, value)
+    return engine
+
+
+def _work(connection, directory):
+    # runs in the worker process, one job at a time
+    engine = None
+    voice = None
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        kind, text, properties = job
+        try:
+            if engine is None or properties != voice:
+                engine = _init_engine(properties)
+                voice = properties
+            try:
+                data = _run(engine, kind, text, directory)
+            except RuntimeError:
+                # the engine is wedged, a fresh one gets a second try
+                engine = _init_engine(properties)
+                data = _run(engine, kind, text, directory)
+            connection.send(("ok", data))
+        except Exception as e:
+            try:
+                connection.send(("error", e))
+            except Exception:
+                # the error does not pickle
+                connection.send(("error", RuntimeError(repr(e))))
+
+
+def _run(engine, kind, text, directory):
+    if kind == "say":
+        engine.say(text)
+        engine.runAndWait()
+        return None
+    audio_file = os.path.join(directory, f"{uuid.uuid4()}.mp3")
+    engine.save_to_file(text, audio_file)
+    engine.runAndWait()
+    try:
+        with open(audio_file, "rb") as f:
+            return f.read()
+    finally:
+        if os.path.exists(audio_file):
+            os.remove(audio_file)
+
+
+class SynthesisWorker:
+    """A pyttsx3 engine in its own process, jobs and audio go over a pipe."""
+
+    def __init__(self, context, name):
+        self.context = context
+        self.name = name
+        self.process = None
+        self.connection = None
+        self.directory = None
+        # the last restart failed, the worker cannot run jobs
+        self.broken = False
+
+    def start(self):
+        parent, child = self.context.Pipe()
+        base = SHARED_MEMORY_DIR if os.path.isdir(SHARED_MEMORY_DIR) else None
+        self.directory = tempfile.mkdtemp(prefix="jaivus-tts-", dir=base)
+        self.process = self.context.Process(
+            target=_work, args=(child, self.directory), name=self.name, daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.connection = parent
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        if self.connection is not None:
+            self.connection.close()
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.process = self.connection = self.directory = None
+
+    def restart(self):
+        self.stop()
+        try:
+            self.start()
+        except Exception:
+            self.broken = True
+            raise
+        self.broken = False
+
+    def run(self, job, timeout):
+        # returns the status and the audio or the error of the job
+        self.connection.send(job)
+        if not self.connection.poll(timeout):
+            raise TimeoutError(f"synthesis took longer than {timeout} seconds")
+        return self.connection.recv()
+
+
+class SynthesisPool:
+    """Pool of pyttsx3 worker processes.
+
+    The pyttsx3 driver is not thread safe, a process per engine lets
+    sentences of all sessions render in parallel. Audio comes back as bytes
+    over a pipe, the engine writes it to a private directory in shared memory
+    instead of the working directory. Workers exceeding `timeout` on a job or
+    dying during one are killed and restarted, the job fails. Workers found
+    dead between jobs are restarted before the next one.
+    """
+
+    def __init__(
+        self,
+        workers=SYNTHESIS_WORKERS,
+        timeout=SYNTHESIS_TIMEOUT,
+        wait_timeout=SYNTHESIS_WAIT_TIMEOUT,
+    ):
+        self.workers = workers
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.jobs = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.restarts = 0
+        self.busy = 0
+        self.closed = False
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        context = multiprocessing.get_context("spawn")
+        self._workers = []
+        self._threads = []
+        for i in range(workers):
+            worker = SynthesisWorker(context, f"synthesizer-{i}")
+            worker.start()
+            self._workers.append(worker)
+            thread = threading.Thread(
+                target=self._serve, args=(worker,), daemon=True, name=worker.name
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "queued": self._queue.qsize(),
+            "jobs": self.jobs,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+        }
+
+    def healthy(self):
+        # dead worker processes are restarted by their thread before the next
+        # job, a worker failing to restart or a dead thread needs a new pool
+        return (
+            not self.closed
+            and all(thread.is_alive() for thread in self._threads)
+            and not any(worker.broken for worker in self._workers)
+        )
+
+    def submit(self, text, say=False, **properties):
+        assert not self.closed
+        future = Future()
+        self._queue.put((("say" if say else "synthesize", text, properties), future))
+        return future
+
+    def synthesize(self, text, **properties):
+        return self._result(self.submit(text, **properties))
+
+    def say(self, text, **properties):
+        # speaks on the local audio device of the server
+        return self._result(self.submit(text, say=True, **properties))
+
+    def _result(self, future):
+        try:
+            return future.result(timeout=self.wait_timeout)
+        except TimeoutError:
+            # a job still queued is dropped
+            future.cancel()
+            raise
+
+    def close(self):
+        self.closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def _serve(self, worker):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                worker.stop()
+                return
+            job, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self.jobs += 1
+                self.busy += 1
+            t = time.time()
+            status, value = "error", RuntimeError(f"{worker.name} did not run the job")
+            try:
+                status, value = self._run_job(worker, job)
+            except Exception as e:
+                # e.g. the worker failed to restart, the thread keeps serving
+                logger.warning(f"{worker.name} failed with: {e!r}")
+                value = e
+            finally:
+                # every caller gets an answer
+                with self._lock:
+                    self.busy -= 1
+                    self.failed += status == "error"
+                if status == "error":
+                    future.set_exception(value)
+                else:
+                    future.set_result(value)
+            logger.info(f"{worker.name} finished {job[0]} in {time.time() - t:.3f}s")
+
+    def _run_job(self, worker, job):
+        if not worker.alive:
+            logger.warning(f"{worker.name} died -> restart worker")
+            with self._lock:
+                self.restarts += 1
+            worker.restart()
+        try:
+            return worker.run(job, self.timeout)
+        except (TimeoutError, EOFError, OSError) as e:
+            # the worker is wedged or died, the next job gets a fresh one
+            logger.warning(f"{worker.name} failed with: {e!r} -> restart worker")
+            with self._lock:
+                self.restarts += 1
+                self.timeouts += isinstance(e, TimeoutError)
+            worker.restart()
+            return "error", e
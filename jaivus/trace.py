@@ -0,0 +1,217 @@
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# histogram buckets of span durations in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+MAX_TURNS = 100
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self.tracer.record(self.name, time.time() - self.start, **self.attributes)
+        return False
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Tracer:
+    """Latency spans, counters and stats of the running process.
+
+    Span durations feed a histogram per span name. Spans of calls made with
+    `run_in_turn` are also recorded in that turn, the last `max_turns`
+    turns are kept and, with `path` set, appended to a JSON lines file.
+    Objects with a `stats` property can be registered with `collect`, their
+    numeric stats are exported as gauges. A disabled tracer hands out a
+    shared no-op span and records nothing, except in turns started with
+    `traced`, e.g. of a session showing the debug panel.
+    """
+
+    def __init__(self, enabled=False, path=None, max_turns=MAX_TURNS):
+        self.enabled = enabled
+        self.path = path
+        self.turns = deque(maxlen=max_turns)
+        self.histograms = {}
+        self.counters = {}
+        self._collected = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self):
+        # enabled for the process, or the current thread runs in a traced turn
+        return self.enabled or getattr(self._local, "turn", None) is not None
+
+    def span(self, name, **attributes):
+        if not self.active:
+            return NULL_SPAN
+        return Span(self, name, attributes)
+
+    def new_turn(self, session_id, traced=False):
+        # the record of a turn, spans of calls run in it are added to it,
+        # `traced` turns are recorded even if the tracer is disabled
+        if not (self.enabled or traced):
+            return None
+        return {
+            "session": session_id,
+            "turn": uuid.uuid4().hex,
+            "start": time.time(),
+            "spans": [],
+        }
+
+    def run_in_turn(self, turn, function, *args):
+        # runs the function with its spans recorded in the turn, on any thread
+        previous = getattr(self._local, "turn", None)
+        self._local.turn = turn
+        try:
+            return function(*args)
+        finally:
+            self._local.turn = previous
+
+    def record(self, name, duration, **attributes):
+        # records a span measured by the caller, durations in seconds
+        if not self.active:
+            return
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].observe(duration)
+        turn = getattr(self._local, "turn", None)
+        if turn is not None and name != "turn":
+            turn["spans"].append(
+                dict(name=name, duration=round(duration, 6), **attributes)
+            )
+
+    def count(self, name, value=1):
+        if not self.active:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def collect(self, name, source, **labels):
+        # exports the stats of the source as gauges while it is alive
+        key = (name, tuple(sorted(labels.items())))
+        self._collected[key] = weakref.ref(source)
+
+    def finish(self, record):
+        with self._lock:
+            self.turns.append(record)
+        if self.path is not None:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record) + "\n")
+            except OSError as e:
+                logger.warning(f"writing trace failed with: {e}")
+
+    def gauges(self):
+        # yields name, labels and value of the numeric stats of live sources
+        for key, ref in list(self._collected.items()):
+            source = ref()
+            if source is None:
+                self._collected.pop(key, None)
+                continue
+            name, labels = key
+            for stat, value in _flatten(source.stats):
+                yield _metric_name(f"{name}_{stat}"), dict(labels), value
+
+    def export_prometheus(self):
+        lines = []
+        with self._lock:
+            histograms = list(self.histograms.items())
+            counters = list(self.counters.items())
+        for name, histogram in histograms:
+            metric = _metric_name(f"jaivus_{name}_seconds")
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bucket}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram.count}')
+            lines.append(f"{metric}_sum {histogram.sum}")
+            lines.append(f"{metric}_count {histogram.count}")
+        for name, value in counters:
+            metric = _metric_name(f"jaivus_{name}_total")
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value}")
+        for name, labels, value in self.gauges():
+            metric = f"jaivus_{name}"
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(
+                f"{metric}{{{label_text}}} {value}"
+                if label_text
+                else f"{metric} {value}"
+            )
+        return "\n".join(lines) + "\n"
+
+    def recent_turns(self, session_id=None):
+        # a copy of the kept turns, other threads append to them
+        with self._lock:
+            turns = list(self.turns)
+        if session_id is None:
+            return turns
+        return [turn for turn in turns if turn["session"] == session_id]
+
+    def export_jsonl(self):
+        turns = self.recent_turns()
+        return "".join(json.dumps(turn) + "\n" for turn in turns)
+
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def _flatten(stats, prefix=""):
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{prefix}{key}_")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}{key}", value
+
+
+# enabled with JAIVUS_TRACE=1, turns are appended to JAIVUS_TRACE_FILE if set
+TRACER = Tracer(
+    enabled=os.environ.get("JAIVUS_TRACE") == "1",
+    path=os.environ.get("JAIVUS_TRACE_FILE"),
+)
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPT_DIR = os.path.join(tempfile.gettempdir(), "jaivus", "transcripts")
+# seconds after the last turn until a transcript is deleted
+TRANSCRIPT_TTL = 24 * 3600
+EXPORT_FORMATS = {
+    "txt": "text/plain",
+    "json": "application/json",
+    "md": "text/markdown",
+}
+
+
+def expire_transcripts(directory=TRANSCRIPT_DIR, ttl=TRANSCRIPT_TTL):
+    # deletes the transcripts of sessions without a turn for `ttl` seconds
+    now = time.time()
+    for entry in os.scandir(directory):
+        try:
+            if entry.name.endswith(".jsonl") and now - entry.stat().st_mtime > ttl:
+                os.remove(entry.path)
+                logger.info(f"deleted expired transcript {entry.name}")
+        except OSError as e:
+            logger.warning(f"deleting transcript {entry.name} failed with: {e}")
+
+
+class TranscriptLog:
+    """Append-only JSON lines transcript of a session.
+
+    Each turn is written once when it happens, exports read the log back
+    in chunks on demand. Starting a log deletes the logs of sessions without
+    a turn for `ttl` seconds, e.g. of closed browser tabs.
+    """
+
+    def __init__(self, session_id=None, directory=TRANSCRIPT_DIR, ttl=TRANSCRIPT_TTL):
+        self.session_id = session_id or uuid.uuid4().hex
+        os.makedirs(directory, exist_ok=True)
+        expire_transcripts(directory, ttl)
+        self.path = os.path.join(directory, f"{self.session_id}.jsonl")
+        self.turns = 0
+
+    def __len__(self):
+        return self.turns
+
+    def append(self, speaker, text, **fields):
+        # fields are extra metadata of the turn, e.g. latencies in seconds
+        record = {
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "speaker": speaker,
+            "text": text,
+            **fields,
+        }
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        self.turns += 1
+
+    def records(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def export(self, format="txt"):
+        # yields the transcript in chunks of the given format
+        assert format in EXPORT_FORMATS
+        if format == "json":
+            yield "["
+            for i, record in enumerate(self.records()):
+                yield ("," if i else "") + "\n  " + json.dumps(record)
+            yield "\n]\n"
+        elif format == "md":
+            yield "# jAIvus conversation\n"
+            for record in self.records():
+                yield f"\n**{record['speaker']}** _{record['time']}_\n\n{record['text'].strip()}\n"
+        else:
+            for record in self.records():
+                yield f"{record['speaker']}: {record['text'].strip()}\n"
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.turns = 0
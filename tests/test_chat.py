@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from jaivus.chat import CachedBot, Conversation, OpenAIBot
+from jaivus.cache import LRUCache
+
+
+def complete(prompt, **params):
+    # answers every prompt of a batch with its own index
+    return {
+        "choices": [{"index": i, "text": f" answer {i}"} for i in range(len(prompt))]
+    }
+
+
+class AsyncChatTest(unittest.TestCase):
+    def setUp(self):
+        # dispatchers are shared by the bots of an account, so is the patch
+        patch = mock.patch("jaivus.client.OpenAIClient.complete", side_effect=complete)
+        self.complete = patch.start()
+        self.addCleanup(patch.stop)
+        self.bot = OpenAIBot({"api_key": "test-achat", "max_batch_wait": 0.05})
+
+    def test_concurrent_chats_are_answered(self):
+        async def chat():
+            conversations = [Conversation(), Conversation()]
+            answers = await asyncio.gather(
+                *(self.bot.achat("hello", c) for c in conversations)
+            )
+            return answers, conversations
+
+        answers, conversations = asyncio.run(chat())
+        self.assertEqual(sorted(answers), [" answer 0", " answer 1"])
+        for answer, conversation in zip(answers, conversations):
+            self.assertEqual(conversation.turns[-1][1], f"Jarvis: {answer.strip()}\n")
+
+    def test_cached_bot_answers_repeated_prompts(self):
+        bot = CachedBot(self.bot, LRUCache(), max_temperature=1)
+        first = asyncio.run(bot.achat("hello"))
+        self.assertEqual(asyncio.run(bot.achat("Hello!")), first)
+        self.assertEqual(self.complete.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+
+from jaivus.client import BatchDispatcher, OpenAIClient, OpenAIError, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TokenBucketTest(unittest.TestCase):
+    def run_requests(self, per_minute, cost, count):
+        # returns the simulated seconds `count` requests of `cost` took
+        clock = Clock()
+        with mock.patch("jaivus.client.time", clock):
+            bucket = TokenBucket(per_minute / 60)
+            start = clock.now
+            for _ in range(count):
+                bucket.acquire(cost)
+            return clock.now - start
+
+    def test_requests_per_minute(self):
+        # the first request is free, the other 3 wait for a third of a minute each
+        self.assertAlmostEqual(self.run_requests(20, 1, 4), 9, places=6)
+
+    def test_requests_larger_than_a_second_are_charged_in_full(self):
+        elapsed = self.run_requests(40000, 1100, 60)
+        self.assertGreaterEqual(elapsed, (60 * 1100 - 40000 / 60) / 40000 * 60)
+
+
+class BatchDispatcherTest(unittest.TestCase):
+    def test_malformed_response_fails_the_callers(self):
+        client = OpenAIClient("key")
+        dispatcher = BatchDispatcher(client, max_wait=0)
+        with mock.patch.object(client, "complete", return_value={"choices": [{}]}):
+            future = dispatcher.submit("prompt", max_tokens=1)
+            with self.assertRaises(Exception):
+                future.result(timeout=5)
+
+    def test_close_stops_the_thread_and_fails_queued_requests(self):
+        dispatcher = BatchDispatcher(OpenAIClient("key"), max_wait=60)
+        future = dispatcher.submit("prompt", max_tokens=1)
+        dispatcher.close()
+        self.assertFalse(dispatcher._thread.is_alive())
+        with self.assertRaises(OpenAIError):
+            future.result(timeout=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import sys
+import threading
+import unittest
+
+from jaivus.pool import EnginePool
+
+
+class Engine:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class EnginePoolTest(unittest.TestCase):
+    def setUp(self):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+
+    def run_threads(self, targets):
+        errors = []
+
+        def run(target):
+            try:
+                target()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(t,)) for t in targets]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_concurrent_get_and_evict(self):
+        pool = EnginePool(idle_timeout=0)
+        engines = []
+
+        def get():
+            for i in range(500):
+                engines.append(pool.get("engine", i % 7, Engine))
+
+        def evict():
+            for _ in range(500):
+                pool.evict_idle()
+
+        self.run_threads([get] * 4 + [evict])
+        stats = pool.stats
+        self.assertEqual(stats["built"] + stats["reused"], 2000)
+        self.assertEqual(len(engines), 2000)
+        # evicted engines are closed, pooled ones are not
+        closed = sum(engine.closed for engine in set(engines))
+        self.assertEqual(closed, stats["evicted"])
+        self.assertEqual(len(set(engines)) - closed, len(pool))
+        self.assertLessEqual(len(pool._locks), 7)
+
+    def test_concurrent_get_builds_once(self):
+        pool = EnginePool()
+        built = []
+
+        def factory():
+            built.append(Engine())
+            return built[-1]
+
+        engines = []
+        self.run_threads([lambda: engines.append(pool.get("engine", 1, factory))] * 8)
+        self.assertEqual(len(built), 1)
+        self.assertTrue(all(engine is built[0] for engine in engines))
+        self.assertEqual(pool.stats["reused"], 7)
+        self.assertEqual(pool._locks, {})
+
+    def test_unhealthy_engine_is_closed_and_rebuilt(self):
+        pool = EnginePool()
+        engine = pool.get("engine", 1, Engine)
+        engine.healthy = lambda: False
+        rebuilt = pool.get("engine", 1, Engine)
+        self.assertIsNot(rebuilt, engine)
+        self.assertTrue(engine.closed)
+        self.assertEqual(pool.stats["evicted"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
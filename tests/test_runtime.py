@@ -0,0 +1,129 @@
+import threading
+import time
+import unittest
+
+from jaivus.chat import Conversation
+from jaivus.runtime import Runtime
+
+ANSWER = "First sentence is fairly long here. Second sentence is slow to render."
+
+
+class Listener:
+    def __init__(self, answered):
+        self.answered = answered
+        self.barge_in = False
+        self.hearing_speech = False
+
+    def start_listening(self):
+        self.barge_in = False
+
+    def start_barge_in(self):
+        self.barge_in = True
+
+    def stop_barge_in(self):
+        self.barge_in = False
+
+    def poll(self, timeout=1):
+        time.sleep(0.02)
+        if self.barge_in:
+            # the user speaks once the completion ended
+            return ["interruption"] if self.answered.is_set() else []
+        return [] if self.answered.is_set() else ["hello"]
+
+    def recognize(self, audio):
+        return audio if audio == "hello" else None
+
+
+class Bot:
+    # records the answer once the stream ends, like OpenAIBot
+    def __init__(self, answered):
+        self.answered = answered
+
+    def chat_stream(self, prompt, conversation):
+        conversation.add(conversation.user, prompt)
+        yield ANSWER
+        conversation.add(conversation.assistant, ANSWER)
+        self.answered.set()
+
+
+class Speaker:
+    def synthesize_cached(self, text):
+        time.sleep(0.01 if text.startswith("First") else 2)
+        return b"audio"
+
+
+class BargeInTest(unittest.TestCase):
+    def read_until(self, session, expected, timeout=10):
+        deadline = time.time() + timeout
+        while session.next_event(timeout=1) != expected:
+            self.assertLess(time.time(), deadline, f"no {expected} event")
+
+    def test_barge_in_after_the_completion_replaces_the_answer(self):
+        answered = threading.Event()
+        conversation = Conversation()
+        runtime = Runtime()
+        session = runtime.start_session(
+            "test",
+            listener=Listener(answered),
+            chatbot=Bot(answered),
+            speaker=Speaker(),
+            conversation=conversation,
+            barge_in=True,
+        )
+        self.read_until(session, ("interrupt", None))
+        # the interruption is recorded before the next turn listens
+        self.read_until(session, ("state", "listening"))
+        runtime.stop_session("test")
+        turns = [line for _, line, _ in conversation.turns]
+        self.assertEqual(
+            turns, ["You: hello\n", "Jarvis: First sentence is fairly long here.\n"]
+        )
+
+
+class Dictation:
+    # three utterances in a row, each slow to recognize
+    def __init__(self):
+        self.utterances = ["one", "two", "three"]
+
+    def start_listening(self):
+        pass
+
+    def poll(self, timeout=1):
+        time.sleep(0.01)
+        return [self.utterances.pop(0)] if self.utterances else []
+
+    def recognize(self, audio):
+        time.sleep(0.2)
+        return audio
+
+
+class Echo:
+    def chat_stream(self, prompt, conversation):
+        yield prompt
+
+
+class RecognitionStageTest(unittest.TestCase):
+    def test_capture_continues_while_recognizing(self):
+        runtime = Runtime()
+        session = runtime.start_session(
+            "dictation", listener=Dictation(), chatbot=Echo(), speaker=object()
+        )
+        heard = []
+        deadline = time.time() + 10
+        while len(heard) < 3:
+            self.assertLess(time.time(), deadline)
+            event = session.next_event(timeout=1)
+            if event is not None and event[0] == "user":
+                heard.append(event[1])
+        stats = runtime.stats["recognition"]
+        runtime.stop_session("dictation")
+        self.assertEqual(heard, ["one", "two", "three"])
+        # the second utterance was captured during the first recognition,
+        # the third waited for a slot
+        self.assertEqual(stats["submitted"], 3)
+        self.assertEqual(stats["peak_in_flight"], 2)
+        self.assertEqual(stats["backpressure_waits"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from jaivus.speak import PipelinedSpeaker, SentenceSplitter, split_sentences
+
+
+class SentenceSplitterTest(unittest.TestCase):
+    def test_splits_at_sentence_ends_only(self):
+        self.assertEqual(
+            split_sentences("Note this: it works; mostly. Is that clear? Yes it is!"),
+            ["Note this: it works; mostly.", "Is that clear? Yes it is!"],
+        )
+
+    def test_abbreviations_and_initials_end_no_sentence(self):
+        self.assertEqual(
+            split_sentences("Dr. Smith met J. R. R. Tolkien there. He was happy."),
+            ["Dr. Smith met J. R. R. Tolkien there.", "He was happy."],
+        )
+
+    def test_list_markers_stay_with_their_item(self):
+        self.assertEqual(
+            split_sentences(
+                "Sure. Here is a list:\n1. Apples\n2. Pears\n3. Bananas are tasty."
+            ),
+            ["Sure. Here is a list:", "1. Apples 2. Pears 3. Bananas are tasty."],
+        )
+
+    def test_short_fragments_join_the_next_sentence(self):
+        self.assertEqual(
+            split_sentences("Sure! The weather is nice today."),
+            ["Sure! The weather is nice today."],
+        )
+
+    def test_streamed_deltas_split_like_the_whole_text(self):
+        text = "Hello there. Mr. Jones arrived late today!\nWhat now? Nothing much."
+        sentences = SentenceSplitter()
+        streamed = []
+        for character in text:
+            streamed += sentences.feed(character)
+        streamed += sentences.flush()
+        self.assertEqual(streamed, split_sentences(text))
+
+
+class PipelinedSpeakerTest(unittest.TestCase):
+    def test_synthesize_is_abstract(self):
+        with self.assertRaises(TypeError):
+            PipelinedSpeaker()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+import time
+import unittest
+from unittest import mock
+
+from jaivus.synthesis import SynthesisPool, SynthesisWorker
+
+
+class SynthesisPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = SynthesisPool(workers=1, timeout=1, wait_timeout=5)
+        self.addCleanup(self.pool.close)
+
+    def test_failed_restart_fails_the_job_and_keeps_serving(self):
+        with mock.patch.object(
+            SynthesisWorker, "run", side_effect=EOFError
+        ), mock.patch.object(SynthesisWorker, "start", side_effect=OSError("spawn")):
+            with self.assertRaises(OSError):
+                self.pool.synthesize("hello")
+            self.assertFalse(self.pool.healthy())
+            # the serving thread survived and answers the next job
+            with self.assertRaises(OSError):
+                self.pool.synthesize("again")
+        self.assertTrue(all(thread.is_alive() for thread in self.pool._threads))
+        self.assertEqual(self.pool.stats["failed"], 2)
+
+    def test_callers_stop_waiting_after_the_wait_timeout(self):
+        self.pool.wait_timeout = 0.1
+        with mock.patch.object(SynthesisWorker, "run", side_effect=slow_run):
+            with self.assertRaises(TimeoutError):
+                self.pool.synthesize("hello")
+
+
+def slow_run(job, timeout):
+    time.sleep(0.5)
+    return "ok", b""
+
+
+if __name__ == "__main__":
+    unittest.main()
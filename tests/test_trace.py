@@ -0,0 +1,58 @@
+import json
+import sys
+import threading
+import unittest
+
+from jaivus.trace import Tracer
+
+
+class TracerTest(unittest.TestCase):
+    def test_traced_turn_without_enabled_tracer(self):
+        tracer = Tracer()
+        self.assertIsNone(tracer.new_turn("quiet"))
+        turn = tracer.new_turn("debug", traced=True)
+        tracer.run_in_turn(turn, tracer.record, "chat", 0.5)
+        # spans outside of the traced turn stay off
+        tracer.record("chat", 1.0)
+        tracer.count("barge_ins")
+        self.assertFalse(tracer.enabled)
+        self.assertEqual(turn["spans"], [{"name": "chat", "duration": 0.5}])
+        self.assertEqual(tracer.histograms["chat"].count, 1)
+        self.assertEqual(tracer.counters, {})
+
+    def test_recent_turns_by_session(self):
+        tracer = Tracer(enabled=True)
+        for session_id in ("a", "b", "a"):
+            tracer.finish(tracer.new_turn(session_id))
+        self.assertEqual(len(tracer.recent_turns()), 3)
+        self.assertEqual(len(tracer.recent_turns("a")), 2)
+
+    def test_export_while_finishing(self):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        tracer = Tracer(enabled=True, max_turns=50)
+        errors = []
+
+        def finish():
+            for _ in range(2000):
+                tracer.finish(tracer.new_turn("a"))
+
+        def export():
+            try:
+                for _ in range(200):
+                    for line in tracer.export_jsonl().splitlines():
+                        json.loads(line)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=finish), threading.Thread(target=export)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()